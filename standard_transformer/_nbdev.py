@@ -9,30 +9,95 @@ index = {"exists": "01_layers.ipynb",
          "PostNorm": "01_layers.ipynb",
          "PreNorm": "01_layers.ipynb",
          "FeedForward": "01_layers.ipynb",
-         "MASK_VAL": "01_layers.ipynb",
+         "mask_value": "01_layers.ipynb",
+         "upcast_softmax": "01_layers.ipynb",
+         "padding_attn_mask": "01_layers.ipynb",
+         "segment_attn_mask": "01_layers.ipynb",
+         "get_causal_mask": "01_layers.ipynb",
+         "get_rotary_tables": "01_layers.ipynb",
+         "apply_rotary": "01_layers.ipynb",
+         "alibi_slopes": "01_layers.ipynb",
+         "alibi_bias": "01_layers.ipynb",
+         "fused_attention": "01_layers.ipynb",
+         "chunked_attention": "01_layers.ipynb",
+         "local_attn_mask": "01_layers.ipynb",
+         "local_attention": "01_layers.ipynb",
          "Attention": "01_layers.ipynb",
          "AdditiveAttention": "01_layers.ipynb",
          "AttnInProj": "01_layers.ipynb",
          "ScaledDotProdAttention": "01_layers.ipynb",
+         "pool_kv_heads": "01_layers.ipynb",
          "TransformerEncoderBlock": "01_layers.ipynb",
          "TransformerEncoder": "01_layers.ipynb",
+         "evict_cache": "01_layers.ipynb",
+         "truncate_cache": "01_layers.ipynb",
+         "reorder_cache": "01_layers.ipynb",
          "TransformerDecoderBlock": "01_layers.ipynb",
          "TransformerDecoderBlockV2": "01_layers.ipynb",
          "TransformerDecoder": "01_layers.ipynb",
          "AbsolutePositionalEmbedding": "01_layers.ipynb",
          "FixedPositionalEmbedding": "01_layers.ipynb",
+         "segment_positions": "01_layers.ipynb",
+         "get_axial_dims": "01_layers.ipynb",
          "TransformerEmbedding": "01_layers.ipynb",
-         "top_p_filter": "02_models.ipynb",
-         "top_k_filter": "02_models.ipynb",
-         "sampler": "02_models.ipynb",
-         "get_axial_dims": "02_models.ipynb",
+         "sample_logits": "02_models.ipynb",
+         "sampling_probs": "02_models.ipynb",
+         "beam_search": "02_models.ipynb",
          "LMMixin": "02_models.ipynb",
          "EncDecMixin": "02_models.ipynb",
          "TransformerLM": "02_models.ipynb",
-         "Transformer": "02_models.ipynb"}
+         "speculative_decoding": "02_models.ipynb",
+         "Transformer": "02_models.ipynb",
+         "pack_sequences": "03_data.ipynb",
+         "PackedBatchSampler": "03_data.ipynb",
+         "write_token_corpus": "03_data.ipynb",
+         "TokenCorpus": "03_data.ipynb",
+         "LMStreamDataset": "03_data.ipynb",
+         "PeakMemory": "04_benchmark.ipynb",
+         "register_benchmark": "04_benchmark.ipynb",
+         "BENCHMARKS": "04_benchmark.ipynb",
+         "VOCAB_SZ": "04_benchmark.ipynb",
+         "GEN_LEN": "04_benchmark.ipynb",
+         "benchmark": "04_benchmark.ipynb",
+         "run_benchmarks": "04_benchmark.ipynb",
+         "save_results": "04_benchmark.ipynb",
+         "load_results": "04_benchmark.ipynb",
+         "compare_results": "04_benchmark.ipynb",
+         "METRICS": "04_benchmark.ipynb",
+         "import_time": "04_benchmark.ipynb",
+         "main": "09_distributed.ipynb",
+         "LayerProfiler": "05_profiling.ipynb",
+         "PROFILED_TYPES": "05_profiling.ipynb",
+         "TiedQuantizedEmbedding": "06_quantization.ipynb",
+         "quantize_dynamic": "06_quantization.ipynb",
+         "compare_quantized": "06_quantization.ipynb",
+         "flatten_cache": "07_export.ipynb",
+         "unflatten_cache": "07_export.ipynb",
+         "trace_generation": "07_export.ipynb",
+         "export_generation": "07_export.ipynb",
+         "greedy_generate": "07_export.ipynb",
+         "GenerationRequest": "08_serving.ipynb",
+         "ContinuousBatcher": "08_serving.ipynb",
+         "tied_parameters": "09_distributed.ipynb",
+         "distribute": "09_distributed.ipynb",
+         "params_in_sync": "09_distributed.ipynb",
+         "lm_loss": "09_distributed.ipynb",
+         "seq2seq_loss": "09_distributed.ipynb",
+         "train_step": "09_distributed.ipynb",
+         "shard_batches": "09_distributed.ipynb",
+         "train": "09_distributed.ipynb",
+         "launch": "09_distributed.ipynb",
+         "scaling_benchmark": "09_distributed.ipynb"}
 
 modules = ["layers.py",
-           "models.py"]
+           "models.py",
+           "data.py",
+           "benchmark.py",
+           "profiling.py",
+           "quantization.py",
+           "export.py",
+           "serving.py",
+           "distributed.py"]
 
 doc_url = "https://arampacha.github.io/standard_transformer/"
 
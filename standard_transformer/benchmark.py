@@ -0,0 +1,381 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 04_benchmark.ipynb (unless otherwise specified).
+
+__all__ = ['PeakMemory', 'register_benchmark', 'BENCHMARKS', 'VOCAB_SZ', 'GEN_LEN', 'benchmark', 'run_benchmarks',
+           'save_results', 'load_results', 'compare_results', 'METRICS', 'import_time', 'main']
+
+# Cell
+import argparse, csv, ctypes, gc, itertools, json, subprocess, sys, time
+from functools import partial
+import torch
+from torch import nn
+
+from .layers import *
+from .models import *
+from .quantization import quantize_dynamic, compare_quantized
+from .export import trace_generation, greedy_generate
+from .serving import ContinuousBatcher
+
+# Cell
+def _proc_status(field):
+    "Value of `field` (e.g. 'VmRSS') from /proc/self/status in bytes, None if not available"
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'): return int(line.split()[1]) * 1024
+    except OSError: return None
+
+def _reset_peak_rss():
+    "Returns freed heap memory to OS and resets peak resident set size of the process (Linux only)"
+    try: ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError): pass
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+    except OSError: pass
+
+class PeakMemory:
+    """
+    Context manager measuring peak memory in bytes allocated above the level at entry.
+    Uses CUDA allocator statistics for cuda devices and peak resident set size of the process otherwise
+    (`peak` is None where it isn't available)
+    """
+    def __init__(self, device='cpu'): self.device = torch.device(device)
+    def __enter__(self):
+        gc.collect()
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.start = torch.cuda.memory_allocated(self.device)
+        else:
+            _reset_peak_rss()
+            self.start = _proc_status('VmRSS')
+        return self
+    def __exit__(self, *args):
+        if self.device.type == 'cuda':
+            self.peak = torch.cuda.max_memory_allocated(self.device) - self.start
+        else:
+            hwm = _proc_status('VmHWM')
+            self.peak = None if hwm is None or self.start is None else hwm - self.start
+
+# Cell
+BENCHMARKS = {}
+
+def register_benchmark(name, modes=('eval', 'train')):
+    "Registers benchmark case under `name`, `modes` lists supported modes"
+    def _inner(f):
+        BENCHMARKS[name] = (f, modes)
+        return f
+    return _inner
+
+VOCAB_SZ = 1000
+GEN_LEN = 32
+
+@register_benchmark('feedforward')
+def _feedforward(bs, sl, d_model, n_heads, device, **kwargs):
+    m = FeedForward(d_model).to(device)
+    x = torch.randn(bs, sl, d_model, device=device)
+    return dict(fn=lambda: m(x), module=m, n_tokens=bs*sl)
+
+@register_benchmark('attention')
+def _attention(bs, sl, d_model, n_heads, device, backend='einsum', causal=False, **kwargs):
+    m = Attention(d_model, n_heads, causal=causal, backend=backend).to(device)
+    x = torch.randn(bs, sl, d_model, device=device)
+    return dict(fn=lambda: m(x), module=m, n_tokens=bs*sl)
+
+@register_benchmark('additive_attention')
+def _additive_attention(bs, sl, d_model, n_heads, device, backend='einsum', **kwargs):
+    m = AdditiveAttention(d_model, n_heads, causal=True, backend=backend).to(device)
+    x, context = torch.randn(bs, sl, d_model, device=device), torch.randn(bs, sl, d_model, device=device)
+    return dict(fn=lambda: m(x, context), module=m, n_tokens=bs*sl)
+
+@register_benchmark('sdp_attention')
+def _sdp_attention(bs, sl, d_model, n_heads, device, backend='einsum', causal=False, window_size=None, **kwargs):
+    m = ScaledDotProdAttention(d_model, n_heads, causal=causal, backend=backend, window_size=window_size).to(device)
+    q, k, v = [torch.randn(bs, sl, d_model, device=device, requires_grad=True) for _ in range(3)]
+    return dict(fn=lambda: m(q, k, v), module=m, n_tokens=bs*sl)
+
+@register_benchmark('encoder')
+def _encoder(bs, sl, d_model, n_heads, device, n_layers=2, backend='einsum', causal=False, checkpoint=0,
+             window_size=None, **kwargs):
+    m = TransformerEncoder(d_model, n_layers, n_heads, causal=causal, attn_backend=backend,
+                           checkpoint=checkpoint, attn_window_size=window_size).to(device)
+    x = torch.randn(bs, sl, d_model, device=device)
+    return dict(fn=lambda: m(x), module=m, n_tokens=bs*sl)
+
+def _decoder(bs, sl, d_model, n_heads, device, n_layers=2, backend='einsum', checkpoint=0, comb_attn=False, **kwargs):
+    m = TransformerDecoder(d_model, n_layers, n_heads, comb_attn=comb_attn, attn_backend=backend,
+                           checkpoint=checkpoint).to(device)
+    x, context = torch.randn(bs, sl, d_model, device=device), torch.randn(bs, sl, d_model, device=device)
+    return dict(fn=lambda: m(x, context), module=m, n_tokens=bs*sl)
+
+register_benchmark('decoder')(partial(_decoder, comb_attn=False))
+register_benchmark('decoder_comb_attn')(partial(_decoder, comb_attn=True))
+
+def _maybe_quantize(m, quantize):
+    "Dynamic int8 quantization of model `m` for CPU inference if `quantize`"
+    return quantize_dynamic(m.cpu()) if quantize else m
+
+@register_benchmark('lm_forward', modes=('eval',))
+def _lm_forward(bs, sl, d_model, n_heads, device, n_layers=2, backend='einsum', quantize=False, **kwargs):
+    m = TransformerLM(VOCAB_SZ, d_model, n_layers, n_heads, max_seq_len=sl, attn_backend=backend).to(device)
+    m = _maybe_quantize(m, quantize)
+    x = torch.randint(VOCAB_SZ, (bs, sl), device=device)
+    return dict(fn=lambda: m(x), module=m, n_tokens=bs*sl)
+
+@register_benchmark('lm_quantized', modes=('eval',))
+def _lm_quantized(bs, sl, d_model, n_heads, device, n_layers=2, backend='einsum', **kwargs):
+    "Forward pass of dynamically quantized LM, reports its accuracy compared to the float model by `compare_quantized`"
+    m = TransformerLM(VOCAB_SZ, d_model, n_layers, n_heads, max_seq_len=sl, attn_backend=backend).eval()
+    qm = quantize_dynamic(m)
+    x = torch.randint(VOCAB_SZ, (bs, sl))
+    stats = compare_quantized(m, qm, x)
+    return dict(fn=lambda: qm(x), module=qm, n_tokens=bs*sl, metrics=lambda: stats)
+
+@register_benchmark('lm_generate', modes=('eval',))
+def _lm_generate(bs, sl, d_model, n_heads, device, n_layers=2, backend='einsum', quantize=False, traced=False,
+                 speculative=0, n_kv_heads=None, **kwargs):
+    """
+    Greedy generation of `GEN_LEN` tokens after prompt of length `sl`, with TorchScript graphs if `traced`.
+    If `speculative` > 0 it's the number of tokens proposed per step by a draft made of the first layer of the model
+    """
+    m = TransformerLM(VOCAB_SZ, d_model, n_layers, n_heads, max_seq_len=sl+GEN_LEN+speculative,
+                      attn_backend=backend, n_kv_heads=n_kv_heads).to(device)
+    m = _maybe_quantize(m, quantize)
+    inp = torch.randint(VOCAB_SZ, (bs, sl), device=device)
+    stats = {}
+    if traced:
+        prefill, step = trace_generation(m, inp)
+        fn = lambda: greedy_generate(prefill, step, inp, max_len=GEN_LEN)
+    elif speculative:
+        draft = TransformerLM(VOCAB_SZ, d_model, 1, n_heads, max_seq_len=sl+GEN_LEN+speculative,
+                              attn_backend=backend, n_kv_heads=n_kv_heads).to(device)
+        # layers missing in the draft are ignored
+        draft.load_state_dict(m.state_dict(), strict=False)
+        draft = _maybe_quantize(draft, quantize).eval()
+        fn = lambda: stats.update(speculative_decoding(m, draft, inp, GEN_LEN, n_draft=speculative, temperature=0)[1])
+    else: fn = lambda: m.generate(inp, max_len=GEN_LEN, method='greedy')
+    metrics = lambda: dict(acceptance_rate=stats['acceptance_rate']) if stats else {}
+    return dict(fn=fn, module=m, n_tokens=bs*GEN_LEN, metrics=metrics)
+
+@register_benchmark('transformer_generate', modes=('eval',))
+def _transformer_generate(bs, sl, d_model, n_heads, device, n_layers=2, backend='einsum', comb_attn=False,
+                          quantize=False, traced=False, n_kv_heads=None, **kwargs):
+    "Greedy generation of `GEN_LEN` tokens for source of length `sl`, with TorchScript graphs if `traced`"
+    m = Transformer(VOCAB_SZ, VOCAB_SZ, d_model, n_layers, n_heads, max_seq_len=max(sl, GEN_LEN+1),
+                    comb_attn=comb_attn, attn_backend=backend, n_kv_heads=n_kv_heads).to(device)
+    m = _maybe_quantize(m, quantize)
+    src = torch.randint(VOCAB_SZ, (bs, sl), device=device)
+    if traced:
+        src_mask = torch.ones_like(src, dtype=torch.bool)
+        encoder, step = trace_generation(m, src, src_mask)
+        fn = lambda: greedy_generate(encoder, step, src, max_len=GEN_LEN, src_mask=src_mask)
+    else: fn = lambda: m.generate(src, max_len=GEN_LEN, method='greedy')
+    return dict(fn=fn, module=m, n_tokens=bs*GEN_LEN)
+
+@register_benchmark('lm_serving', modes=('eval',))
+def _lm_serving(bs, sl, d_model, n_heads, device, n_layers=2, backend='einsum', static=False, **kwargs):
+    """
+    Serves `4*bs` greedy requests with prompts of length `sl` and long-tailed numbers of new tokens (up to `2*GEN_LEN`)
+    with `ContinuousBatcher` or, if `static`, by `generate` in batches of `bs` running until their longest request is done
+    """
+    m = TransformerLM(VOCAB_SZ, d_model, n_layers, n_heads, max_seq_len=sl+2*GEN_LEN, attn_backend=backend).to(device)
+    prompts = torch.randint(VOCAB_SZ, (4*bs, sl), device=device)
+    max_new = (2 * GEN_LEN * torch.rand(4*bs)**3).long().clamp(min=1).tolist()
+    def serve():
+        batcher = ContinuousBatcher(m, max_batch_size=bs)
+        for p, n in zip(prompts, max_new): batcher.add(p, max_new_tokens=n, temperature=0)
+        batcher.run()
+    def serve_static():
+        for i in range(0, len(prompts), bs):
+            m.generate(prompts[i:i+bs], max_len=max(max_new[i:i+bs]), method='greedy')
+    return dict(fn=serve_static if static else serve, module=m, n_tokens=sum(max_new))
+
+# Cell
+def _percentile(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(q / 100 * (len(xs) - 1))))]
+
+def _sync(device):
+    if torch.device(device).type == 'cuda': torch.cuda.synchronize(device)
+
+def benchmark(name, bs=8, sl=128, d_model=256, n_heads=8, mode='eval', n_warmup=2, n_iter=10, device='cpu',
+              autocast=None, **kwargs):
+    """
+    Runs benchmark case `name` `n_iter` times after `n_warmup` runs and returns dict with the settings,
+    tokens/sec (at median latency), latency percentiles in ms, peak memory in MB and metrics reported by the case.
+    `mode` is 'eval' (inference without gradients) or 'train' (forward and backward pass),
+    `autocast` is dtype name (e.g. 'bfloat16') to run the case under `torch.autocast` with,
+    other `kwargs` (e.g. `backend`, `n_layers`, `checkpoint`) are passed to the case
+    """
+    setup, modes = BENCHMARKS[name]
+    assert mode in modes, f'{name} supports modes {modes}'
+    torch.manual_seed(0)
+    case = setup(bs, sl, d_model, n_heads, device, **kwargs)
+    case['module'].train(mode == 'train')
+    if exists(autocast): kwargs['autocast'] = autocast
+    amp_dtype = getattr(torch, autocast) if exists(autocast) else None
+    def step():
+        with torch.autocast(torch.device(device).type, dtype=amp_dtype, enabled=exists(autocast)):
+            if mode == 'train': out = case['fn']()
+            else:
+                with torch.no_grad(): case['fn']()
+        if mode == 'train':
+            out.float().sum().backward()
+            case['module'].zero_grad(set_to_none=True)
+        _sync(device)
+    for _ in range(n_warmup): step()
+    latencies = []
+    with PeakMemory(device) as mem:
+        for _ in range(n_iter):
+            start = time.perf_counter()
+            step()
+            latencies.append(time.perf_counter() - start)
+    p50 = _percentile(latencies, 50)
+    return dict(name=name, mode=mode, bs=bs, sl=sl, d_model=d_model, n_heads=n_heads,
+                **{k: v for k, v in sorted(kwargs.items())},
+                tokens_per_sec=case['n_tokens'] / p50, latency_mean_ms=1e3 * sum(latencies) / len(latencies),
+                latency_p50_ms=1e3 * p50, latency_p90_ms=1e3 * _percentile(latencies, 90),
+                latency_p99_ms=1e3 * _percentile(latencies, 99),
+                peak_mem_mb=None if mem.peak is None else mem.peak / 2**20, **case.get('metrics', dict)())
+
+def run_benchmarks(names=None, bs=(8,), sl=(128,), d_model=(256,), n_heads=(8,), modes=('eval', 'train'),
+                   verbose=False, **kwargs):
+    "Sweeps benchmarks `names` (all registered by default) over all combinations of sizes and supported `modes`"
+    results = []
+    for name in names or list(BENCHMARKS):
+        for mode, b, s, d, h in itertools.product(modes, bs, sl, d_model, n_heads):
+            if mode not in BENCHMARKS[name][1]: continue
+            res = benchmark(name, bs=b, sl=s, d_model=d, n_heads=h, mode=mode, **kwargs)
+            if verbose: print(_format_row(res))
+            results.append(res)
+    return results
+
+# Cell
+METRICS = ('tokens_per_sec', 'latency_mean_ms', 'latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms', 'peak_mem_mb',
+           'acceptance_rate', 'ppl', 'ppl_quantized', 'kl_div', 'top1_agreement')
+
+def _key(res): return tuple(sorted((k, v) for k, v in res.items() if k not in METRICS))
+
+def _format_row(res):
+    settings = ' '.join(f'{k}={v}' for k, v in _key(res) if k not in ('name', 'mode'))
+    mem = 'n/a' if res['peak_mem_mb'] is None else f"{res['peak_mem_mb']:.1f}MB"
+    row = (f"{res['name']} [{res['mode']}] {settings}: {res['tokens_per_sec']:.0f} tok/s, p50 {res['latency_p50_ms']:.2f}ms, "
+           f"p99 {res['latency_p99_ms']:.2f}ms, peak mem {mem}")
+    if res.get('acceptance_rate') is not None: row += f", acceptance rate {res['acceptance_rate']:.2f}"
+    if res.get('top1_agreement') is not None:
+        row += (f", ppl {res['ppl']:.2f} -> {res['ppl_quantized']:.2f} quantized, kl {res['kl_div']:.4f}, "
+                f"top-1 agreement {res['top1_agreement']:.3f}")
+    return row
+
+def save_results(results, path):
+    "Saves benchmark `results` to `path`, as CSV if it ends with '.csv' and JSON otherwise"
+    path = str(path)
+    if path.endswith('.csv'):
+        fields = list(dict.fromkeys(k for res in results for k in res))
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, 'w') as f: json.dump(results, f, indent=1)
+
+def _parse(v):
+    if v == '': return None
+    for t in (int, float):
+        try: return t(v)
+        except ValueError: pass
+    return v
+
+def load_results(path):
+    "Loads benchmark results saved by `save_results`"
+    path = str(path)
+    with open(path, newline='') as f:
+        if path.endswith('.csv'): return [{k: _parse(v) for k, v in row.items()} for row in csv.DictReader(f)]
+        return json.load(f)
+
+def compare_results(results, baseline, tolerance=0.2, min_mem_mb=1.):
+    """
+    Compares `results` with `baseline` results of the same settings, returns list of regressions: cases with
+    tokens/sec or top-1 agreement of quantized model lower or peak memory higher (by more than `min_mem_mb`) than
+    baseline by more than `tolerance`
+    """
+    base = {_key(res): res for res in baseline}
+    regressions = []
+    for res in results:
+        b = base.get(_key(res))
+        if b is None: continue
+        if res['tokens_per_sec'] < b['tokens_per_sec'] * (1 - tolerance):
+            regressions.append(dict(key=_key(res), metric='tokens_per_sec', baseline=b['tokens_per_sec'],
+                                    value=res['tokens_per_sec']))
+        if (res['peak_mem_mb'] is not None and b['peak_mem_mb'] is not None and
+                res['peak_mem_mb'] > max(b['peak_mem_mb'] * (1 + tolerance), b['peak_mem_mb'] + min_mem_mb)):
+            regressions.append(dict(key=_key(res), metric='peak_mem_mb', baseline=b['peak_mem_mb'],
+                                    value=res['peak_mem_mb']))
+        if res.get('top1_agreement') is not None and res['top1_agreement'] < b['top1_agreement'] * (1 - tolerance):
+            regressions.append(dict(key=_key(res), metric='top1_agreement', baseline=b['top1_agreement'],
+                                    value=res['top1_agreement']))
+    return regressions
+
+# Cell
+_IMPORT_CODE = ("import resource, sys, time; t = time.perf_counter(); import {module}; t = time.perf_counter() - t; "
+                "print(t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'fastai' in sys.modules)")
+
+def import_time(module='standard_transformer.models', n_runs=3):
+    "Imports `module` in `n_runs` fresh interpreters, returns median time in ms, max RSS in MB and if fastai was imported"
+    runs = []
+    for _ in range(n_runs):
+        out = subprocess.run([sys.executable, '-c', _IMPORT_CODE.format(module=module)], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout.split()
+        runs.append((float(out[0]), int(out[1]), out[2] == 'True'))
+    # ru_maxrss is in KB on Linux
+    return dict(name='import', module=module, import_ms=1e3 * _percentile([r[0] for r in runs], 50),
+                rss_mb=max(r[1] for r in runs) / 2**10, fastai=any(r[2] for r in runs))
+
+# Cell
+def main(args=None):
+    p = argparse.ArgumentParser(description='Benchmark standard_transformer layers and models')
+    p.add_argument('--names', nargs='+', default=None, choices=list(BENCHMARKS))
+    p.add_argument('--bs', nargs='+', type=int, default=[8])
+    p.add_argument('--sl', nargs='+', type=int, default=[128, 256])
+    p.add_argument('--d-model', nargs='+', type=int, default=[256])
+    p.add_argument('--n-heads', nargs='+', type=int, default=[8])
+    p.add_argument('--modes', nargs='+', default=['eval', 'train'], choices=['eval', 'train'])
+    p.add_argument('--backend', default='einsum', choices=['einsum', 'sdpa', 'chunked'])
+    p.add_argument('--n-warmup', type=int, default=2)
+    p.add_argument('--n-iter', type=int, default=10)
+    p.add_argument('--device', default='cpu')
+    p.add_argument('--quantize', action='store_true', help='dynamic int8 quantization of lm_forward and generate cases')
+    p.add_argument('--autocast', default=None, choices=['bfloat16', 'float16'], help='run cases under torch.autocast')
+    p.add_argument('--traced', action='store_true', help='generate cases use TorchScript graphs from trace_generation')
+    p.add_argument('--static', action='store_true', help='lm_serving uses static batching instead of continuous one')
+    p.add_argument('--speculative', type=int, default=0,
+                   help='lm_generate uses speculative decoding with this number of draft tokens per step')
+    p.add_argument('--window-size', type=int, default=None,
+                   help='sdp_attention and encoder cases use local attention with this window size')
+    p.add_argument('--n-kv-heads', type=int, default=None,
+                   help='generate cases use grouped-query attention with this number of key/value heads')
+    p.add_argument('--out', default=None, help='path to save results (.json or .csv)')
+    p.add_argument('--baseline', default=None, help='path to baseline results to compare with')
+    p.add_argument('--tolerance', type=float, default=0.3)
+    p.add_argument('--import-time', action='store_true', help='only measure import time of the library')
+    a = p.parse_args(args)
+    if a.import_time:
+        for module in ['torch', 'standard_transformer.models']: print(import_time(module))
+        return
+    kwargs = dict(quantize=True) if a.quantize else {}
+    if a.autocast: kwargs['autocast'] = a.autocast
+    if a.traced: kwargs['traced'] = True
+    if a.static: kwargs['static'] = True
+    if a.speculative: kwargs['speculative'] = a.speculative
+    if a.window_size: kwargs['window_size'] = a.window_size
+    if a.n_kv_heads: kwargs['n_kv_heads'] = a.n_kv_heads
+    results = run_benchmarks(a.names, bs=a.bs, sl=a.sl, d_model=a.d_model, n_heads=a.n_heads, modes=a.modes,
+                             backend=a.backend, n_warmup=a.n_warmup, n_iter=a.n_iter, device=a.device, verbose=True,
+                             **kwargs)
+    if a.out: save_results(results, a.out)
+    if a.baseline:
+        regressions = compare_results(results, load_results(a.baseline), a.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {' '.join(f'{k}={v}' for k, v in r['key'])}: {r['metric']} {r['baseline']:.2f} -> {r['value']:.2f}")
+        if regressions: sys.exit(1)
+
+if __name__ == '__main__' and 'ipykernel' not in sys.modules: main()
\ No newline at end of file
@@ -0,0 +1,210 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 03_data.ipynb (unless otherwise specified).
+
+__all__ = ['pack_sequences', 'PackedBatchSampler', 'write_token_corpus', 'TokenCorpus', 'LMStreamDataset']
+
+# Cell
+import os
+import numpy as np
+import torch
+from torch.utils.data import Sampler, IterableDataset, get_worker_info
+
+# Cell
+def _as_tuple(x): return tuple(x) if isinstance(x, (tuple, list)) else (x,)
+
+def pack_sequences(samples, max_len, pad_idx=0):
+    """
+    Packs 1d tensors `samples` into rows of `max_len` tokens keeping their order (each row is filled until next sample doesn't fit).
+    Returns tokens [n_rows, max_len] and segment_ids [n_rows, max_len] numbering sequences in a row from 1, 0 at padding.
+    For source-target pairs `samples` are tuples of tensors and `max_len` is a tuple, (tokens, segment_ids) are returned for each
+    """
+    is_pair = isinstance(samples[0], (tuple, list))
+    samples, max_len = [_as_tuple(s) for s in samples], _as_tuple(max_len)
+    rows = []
+    for s in samples:
+        assert all(len(t) <= ml for t, ml in zip(s, max_len)), 'sample is longer than max_len'
+        if not rows or any(sum(len(r[c]) for r in rows[-1]) + len(t) > ml for c, (t, ml) in enumerate(zip(s, max_len))):
+            rows.append([])
+        rows[-1].append(s)
+    out = []
+    for c, ml in enumerate(max_len):
+        tokens = samples[0][c].new_full((len(rows), ml), pad_idx)
+        segment_ids = torch.zeros(len(rows), ml, dtype=torch.long)
+        for i, row in enumerate(rows):
+            pos = 0
+            for j, s in enumerate(row, 1):
+                n = len(s[c])
+                tokens[i, pos:pos+n], segment_ids[i, pos:pos+n] = s[c], j
+                pos += n
+        out.append((tokens, segment_ids))
+    return tuple(out) if is_pair else out[0]
+
+# Cell
+class PackedBatchSampler(Sampler):
+    """
+    Batch sampler yielding dataset indices which fill `bs` rows of `max_len` tokens once packed by `pack_sequences`.
+    Indices are shuffled, then sorted by length within pools of `bs*pool_mult` samples and packed first-fit decreasing,
+    so sequences of similar length are batched together and little padding is left.
+    `lengths` are tuples (and `max_len` is a tuple) for source-target pairs. Number of batches can vary between epochs
+    """
+    def __init__(self, lengths, max_len, bs, shuffle=True, pool_mult=50, drop_last=False):
+        self.lengths, self.max_len = [_as_tuple(l) for l in lengths], _as_tuple(max_len)
+        assert all(len(l) == len(self.max_len) for l in self.lengths)
+        self.bs, self.shuffle, self.pool_mult, self.drop_last = bs, shuffle, pool_mult, drop_last
+        self._n_batches = None
+
+    def _pack(self, idxs):
+        "First-fit decreasing packing of `idxs` into rows, returns list of rows of indices"
+        rows, fill = [], []
+        for i in sorted(idxs, key=lambda i: self.lengths[i], reverse=True):
+            l = self.lengths[i]
+            for r, f in enumerate(fill):
+                if all(a + b <= ml for a, b, ml in zip(f, l, self.max_len)):
+                    rows[r].append(i)
+                    fill[r] = tuple(a + b for a, b in zip(f, l))
+                    break
+            else:
+                rows.append([i])
+                fill.append(l)
+        return rows
+
+    def _batches(self):
+        n = len(self.lengths)
+        idxs = torch.randperm(n).tolist() if self.shuffle else list(range(n))
+        pool_sz = self.bs * self.pool_mult
+        batches = []
+        for p in range(0, n, pool_sz):
+            rows = self._pack(idxs[p:p+pool_sz])
+            batches += [sum(rows[r:r+self.bs], []) for r in range(0, len(rows), self.bs)
+                        if not self.drop_last or r + self.bs <= len(rows)]
+        if self.shuffle: batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self._n_batches = len(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self._n_batches is None: self._n_batches = len(self._batches())
+        return self._n_batches
+
+# Cell
+_IDX_MAGIC = b'TOKIDX01'
+# magic followed by numpy dtype string of token ids (e.g. '<u2') padded to 8 bytes
+_IDX_HEADER_SIZE = 16
+
+def write_token_corpus(sequences, path, vocab_sz=None):
+    """
+    Writes iterable of token id `sequences` (lists, arrays or 1d tensors) to flat array `path`.bin and their offsets to
+    `path`.idx with header recording dtype of token ids. Sequences are written one by one, so they can be streamed from
+    a tokenizer. Returns `TokenCorpus`
+    """
+    dtype = np.uint16 if vocab_sz is not None and vocab_sz <= 2**16 else np.uint32
+    offsets = [0]
+    with open(f'{path}.bin', 'wb') as f:
+        for s in sequences:
+            s = np.asarray(s)
+            assert len(s) == 0 or 0 <= s.min() and s.max() < (2**32 if vocab_sz is None else vocab_sz), \
+                'token id out of vocabulary'
+            f.write(s.astype(dtype).tobytes())
+            offsets.append(offsets[-1] + len(s))
+    with open(f'{path}.idx', 'wb') as f:
+        f.write(_IDX_MAGIC + np.dtype(dtype).str.encode().ljust(_IDX_HEADER_SIZE - len(_IDX_MAGIC)))
+        f.write(np.array(offsets, dtype=np.int64).tobytes())
+    return TokenCorpus(path)
+
+class TokenCorpus:
+    """
+    Corpus written by `write_token_corpus` at `path`, `corpus[i]` is i-th sequence and `slice` reads tokens of flat array.
+    Token ids are read from memory-mapped files and converted to int64 tensors
+    """
+    def __init__(self, path):
+        self.path, self._tokens, self._offsets = str(path), None, None
+        with open(f'{self.path}.idx', 'rb') as f: header = f.read(_IDX_HEADER_SIZE)
+        assert header[:len(_IDX_MAGIC)] == _IDX_MAGIC, f'{self.path}.idx is not an index written by write_token_corpus'
+        self.dtype = np.dtype(header[len(_IDX_MAGIC):].decode().strip())
+        assert os.path.getsize(f'{self.path}.bin') == self.n_tokens * self.dtype.itemsize, \
+            f'size of {self.path}.bin does not match its index'
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = np.memmap(f'{self.path}.idx', dtype=np.int64, mode='r', offset=_IDX_HEADER_SIZE)
+        return self._offsets
+
+    @property
+    def tokens(self):
+        if self._tokens is None: self._tokens = np.memmap(f'{self.path}.bin', dtype=self.dtype, mode='r')
+        return self._tokens
+
+    def __getstate__(self):
+        # DataLoader workers map the files again instead of receiving pickled copies of their data
+        return dict(self.__dict__, _tokens=None, _offsets=None)
+
+    @property
+    def n_tokens(self): return int(self.offsets[-1])
+
+    @property
+    def lengths(self): return np.diff(self.offsets)
+
+    def __len__(self): return len(self.offsets) - 1
+
+    def __getitem__(self, i): return self.slice(self.offsets[i], self.offsets[i+1])
+
+    def slice(self, start, end):
+        "Tokens `start:end` of the flat array as int64 tensor"
+        return torch.from_numpy(self.tokens[start:end].astype(np.int64))
+
+# Cell
+class LMStreamDataset(IterableDataset):
+    """
+    Streams batches from `TokenCorpus` `corpus`: windows [bs, seq_len+1] of the flat array starting every `seq_len`
+    tokens, so consecutive windows share one token and each gives `seq_len` next token targets (shorter tail is
+    dropped), or, if `packed`, whole sequences (longer ones are split) packed by `pack_sequences` into tokens and
+    segment_ids padded with `pad_idx`. Windows or sequences are shuffled each epoch (see `set_epoch`)
+    if `shuffle` and sharded between `world_size` processes (this one is `rank`) and their DataLoader workers.
+    Batches are formed by the dataset, so it's used with `DataLoader(ds, batch_size=None, num_workers=n)`
+    """
+    def __init__(self, corpus, bs, seq_len, packed=False, pad_idx=0, shuffle=True, seed=0, rank=0, world_size=1,
+                 drop_last=False):
+        self.corpus, self.bs, self.seq_len, self.packed, self.pad_idx = corpus, bs, seq_len, packed, pad_idx
+        self.shuffle, self.seed, self.rank, self.world_size, self.drop_last = shuffle, seed, rank, world_size, drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        "Sets epoch used to seed shuffling, call before creating DataLoader iterator (workers get a copy of dataset)"
+        self.epoch = epoch
+
+    def _shard(self, n):
+        "Indices out of `n` windows or sequences read by current worker"
+        info = get_worker_info()
+        n_workers, worker = (info.num_workers, info.id) if info is not None else (1, 0)
+        if self.shuffle: order = torch.randperm(n, generator=torch.Generator().manual_seed(self.seed + self.epoch))
+        else: order = torch.arange(n)
+        return order[self.rank * n_workers + worker::self.world_size * n_workers].tolist()
+
+    def _windows(self):
+        batch = []
+        for w in self._shard((self.corpus.n_tokens - 1) // self.seq_len):
+            batch.append(self.corpus.slice(w * self.seq_len, (w + 1) * self.seq_len + 1))
+            if len(batch) == self.bs:
+                yield torch.stack(batch)
+                batch = []
+        if batch and not self.drop_last: yield torch.stack(batch)
+
+    def _packed(self):
+        # samples are collected until they fill `bs` rows the same way `pack_sequences` fills them
+        samples, n_rows, fill = [], 0, self.seq_len
+        for i in self._shard(len(self.corpus)):
+            for s in self.corpus[i].split(self.seq_len):
+                if fill + len(s) > self.seq_len:
+                    if n_rows == self.bs:
+                        yield pack_sequences(samples, self.seq_len, self.pad_idx)
+                        samples, n_rows = [], 0
+                    n_rows, fill = n_rows + 1, 0
+                samples.append(s)
+                fill += len(s)
+        if samples and not (self.drop_last and n_rows < self.bs): yield pack_sequences(samples, self.seq_len, self.pad_idx)
+
+    def __iter__(self):
+        return self._packed() if self.packed else self._windows()
\ No newline at end of file
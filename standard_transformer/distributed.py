@@ -0,0 +1,218 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 09_distributed.ipynb (unless otherwise specified).
+
+__all__ = ['tied_parameters', 'distribute', 'params_in_sync', 'lm_loss', 'seq2seq_loss', 'train_step', 'shard_batches',
+           'train', 'launch', 'scaling_benchmark', 'main']
+
+# Cell
+import argparse, contextlib, inspect, itertools, os, socket, sys, tempfile, time
+from functools import partial
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from .layers import *
+from .models import TransformerLM, Transformer
+from .data import pack_sequences, write_token_corpus, LMStreamDataset
+from .benchmark import save_results
+
+# Cell
+def tied_parameters(model):
+    "Returns groups of names under which the same parameter is registered in `model`, e.g. tied embedding and projection"
+    names = {}
+    for name, p in model.state_dict(keep_vars=True).items():
+        if isinstance(p, nn.Parameter): names.setdefault(id(p), []).append(name)
+    return [n for n in names.values() if len(n) > 1]
+
+# Cell
+def distribute(model, bucket_cap_mb=25, **kwargs):
+    """
+    Wraps `model` into `DistributedDataParallel` which averages gradients between processes of the default group in
+    buckets of `bucket_cap_mb` MB overlapping with backward pass, returns `model` if no process group is initialized.
+    Parameters are broadcast from rank 0, gradients are views of the buckets. `kwargs` are passed to DDP
+    """
+    if not (dist.is_available() and dist.is_initialized()): return model
+    # cached masks and tables may have different sizes in different processes, they aren't synced in forward
+    # (`broadcast_buffers` is deprecated in favour of `forward_sync_buffers` by newer torch)
+    sync = 'forward_sync_buffers' if 'forward_sync_buffers' in inspect.signature(DistributedDataParallel).parameters \
+        else 'broadcast_buffers'
+    kwargs = {sync: False, **kwargs}
+    return DistributedDataParallel(model, bucket_cap_mb=bucket_cap_mb, gradient_as_bucket_view=True, **kwargs)
+
+@torch.no_grad()
+def params_in_sync(model):
+    "Checks that all processes hold the same parameters by comparing per-parameter checksums with the ones of rank 0"
+    sums = torch.stack([torch.stack([p.double().sum(), p.double().norm()]) for p in model.parameters()])
+    if not dist.is_initialized(): return True
+    ref = sums.clone()
+    dist.broadcast(ref, 0)
+    ok = torch.tensor(int(torch.equal(sums, ref)))
+    dist.all_reduce(ok, op=dist.ReduceOp.MIN)
+    return bool(ok)
+
+# Cell
+def lm_loss(model, batch):
+    """
+    Next token cross-entropy of LM `model` on `batch` of token ids [bs, sl] or (tokens, segment_ids) packed by
+    `pack_sequences`, targets in next segment or in padding are ignored for packed batches
+    """
+    if isinstance(batch, (tuple, list)):
+        x, segment_ids = batch
+        logits = model(x[:, :-1], segment_ids=segment_ids[:, :-1])
+        ignore = (segment_ids[:, 1:] != segment_ids[:, :-1]) | (segment_ids[:, 1:] == 0)
+        y = x[:, 1:].masked_fill(ignore, -100)
+    else: logits, y = model(batch[:, :-1]), batch[:, 1:]
+    return F.cross_entropy(logits.flatten(0, 1), y.flatten(), ignore_index=-100)
+
+def seq2seq_loss(model, batch, pad_idx=None):
+    "Cross-entropy of encoder-decoder `model` on `batch` of (src, tgt) ids, a tensor is used as both src and tgt"
+    src, tgt = batch if isinstance(batch, (tuple, list)) else (batch, batch)
+    logits = model(src, tgt[:, :-1])
+    return F.cross_entropy(logits.flatten(0, 1), tgt[:, 1:].flatten(), ignore_index=default(pad_idx, -100))
+
+def train_step(model, opt, batches, loss_fn=lm_loss):
+    "Accumulates gradients of `loss_fn(model, batch)` over micro-batches `batches` and makes step of `opt`, returns loss"
+    loss = 0.
+    for i, b in enumerate(batches):
+        sync = i == len(batches) - 1 or not isinstance(model, DistributedDataParallel)
+        with contextlib.nullcontext() if sync else model.no_sync():
+            l = loss_fn(model, b) / len(batches)
+            l.backward()
+        loss += l.item()
+    opt.step()
+    opt.zero_grad()
+    return loss
+
+# Cell
+def shard_batches(batches, rank=0, world_size=1):
+    "Every `world_size`-th batch of list `batches` starting with `rank`-th"
+    return batches[rank::world_size]
+
+def _all_ranks(flag):
+    "True if `flag` is true in all processes"
+    if not dist.is_initialized(): return flag
+    t = torch.tensor(int(flag))
+    dist.all_reduce(t, op=dist.ReduceOp.MIN)
+    return bool(t)
+
+def _n_tokens(batch):
+    return (batch[0] if isinstance(batch, (tuple, list)) else batch).numel()
+
+def train(rank, world_size, make_model, make_batches, n_steps=None, loss_fn=lm_loss, accum_steps=1,
+          opt_func=torch.optim.AdamW, lr=1e-3, bucket_cap_mb=25, seed=0, save_path=None):
+    """
+    Trains model returned by `make_model()` in process `rank` of `world_size` for `n_steps` (or until data runs out) of
+    `accum_steps` micro-batches from `make_batches(rank=rank, world_size=world_size)`, e.g. `partial(LMStreamDataset,
+    corpus, bs, seq_len)`. Rank 0 saves state dict to `save_path`. Returns dict with local losses, tokens and times of steps
+    """
+    torch.manual_seed(seed)
+    model = distribute(make_model(), bucket_cap_mb=bucket_cap_mb).train()
+    # dropout masks differ between processes
+    torch.manual_seed(seed + rank)
+    opt = opt_func(model.parameters(), lr=lr)
+    batches = iter(make_batches(rank=rank, world_size=world_size))
+    losses, n_tokens, step_times = [], [], []
+    for _ in range(n_steps) if n_steps is not None else itertools.count():
+        micro = list(itertools.islice(batches, accum_steps))
+        if not _all_ranks(len(micro) == accum_steps): break
+        t = time.perf_counter()
+        losses.append(train_step(model, opt, micro, loss_fn))
+        step_times.append(time.perf_counter() - t)
+        n_tokens.append(sum(_n_tokens(b) for b in micro))
+    module = model.module if isinstance(model, DistributedDataParallel) else model
+    if save_path is not None and rank == 0: torch.save(module.state_dict(), save_path)
+    return dict(rank=rank, losses=losses, n_tokens=n_tokens, step_times=step_times, in_sync=params_in_sync(model))
+
+# Cell
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _run(rank, fn, world_size, port, n_threads, queue, args, kwargs):
+    torch.set_num_threads(n_threads)
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    res = None
+    try: res = fn(rank, world_size, *args, **kwargs)
+    finally:
+        queue.put((rank, res))
+        dist.destroy_process_group()
+
+def launch(fn, world_size, *args, n_threads=None, start_method='spawn', **kwargs):
+    """
+    Runs `fn(rank, world_size, *args, **kwargs)` in `world_size` processes joined into gloo process group, returns list of
+    results by rank. Each process uses `n_threads` threads, by default available cores are split evenly between them
+    """
+    n_threads = default(n_threads, max(1, len(os.sched_getaffinity(0)) // world_size))
+    queue = mp.get_context(start_method).SimpleQueue()
+    ctx = mp.start_processes(_run, args=(fn, world_size, _free_port(), n_threads, queue, args, kwargs),
+                             nprocs=world_size, join=False, start_method=start_method)
+    results = {}
+    # `join` raises if any of the processes fails, e.g. can't unpickle `fn`
+    while not ctx.join(0.1):
+        while not queue.empty(): results.update([queue.get()])
+    while not queue.empty(): results.update([queue.get()])
+    return [results[r] for r in range(world_size)]
+
+# Cell
+def scaling_benchmark(world_sizes=(1, 2, 4), model='lm', vocab_sz=1024, d_model=256, n_layers=4, heads=8, bs=8,
+                      seq_len=128, accum_steps=1, n_steps=10, n_warmup=2, bucket_cap_mb=25, verbose=False):
+    """
+    Trains `model` ('lm' or 'transformer' with shared embeddings) on random tokens for `n_warmup` + `n_steps` steps of
+    `accum_steps` batches [bs, seq_len+1] per process with each of `world_sizes` processes. Returns list of dicts with
+    throughput in tokens per second, speedup over the first of `world_sizes` and scaling efficiency
+    """
+    if model == 'lm':
+        make_model, loss_fn = partial(TransformerLM, vocab_sz, d_model, n_layers, heads, max_seq_len=seq_len), lm_loss
+    else:
+        # windows of seq_len+1 tokens are used as source too
+        make_model = partial(Transformer, vocab_sz, vocab_sz, d_model, n_layers, heads, max_seq_len=seq_len+1,
+                             shared_emb=True)
+        loss_fn = seq2seq_loss
+    n_tokens = max(world_sizes) * (n_warmup + n_steps) * accum_steps * bs * seq_len + 1
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        corpus = write_token_corpus([np.random.randint(vocab_sz, size=n_tokens)], f'{d}/corpus', vocab_sz)
+        for ws in world_sizes:
+            n_threads = max(1, len(os.sched_getaffinity(0)) // ws)
+            res = launch(train, ws, make_model, partial(LMStreamDataset, corpus, bs, seq_len, shuffle=False),
+                         n_steps=n_warmup + n_steps, loss_fn=loss_fn, accum_steps=accum_steps,
+                         bucket_cap_mb=bucket_cap_mb, n_threads=n_threads)
+            # processes wait for each other every step, so the slowest one sets the pace
+            t = max(sum(r['step_times'][n_warmup:]) for r in res)
+            tps = sum(sum(r['n_tokens'][n_warmup:]) for r in res) / t
+            base = results[0] if results else dict(world_size=ws, tokens_per_sec=tps)
+            speedup = tps / base['tokens_per_sec']
+            results.append(dict(name=f'{model}_train', world_size=ws, n_threads=n_threads, bs=bs, sl=seq_len,
+                                d_model=d_model, accum_steps=accum_steps, tokens_per_sec=tps, speedup=speedup,
+                                efficiency=speedup * base['world_size'] / ws))
+            if verbose:
+                print(f"{model}_train world_size={ws} n_threads={n_threads}: {tps:.0f} tok/s, "
+                      f"speedup {speedup:.2f}, efficiency {results[-1]['efficiency']:.2f}")
+    return results
+
+# Cell
+def main(args=None):
+    p = argparse.ArgumentParser(description='Benchmark scaling of data-parallel CPU training with number of processes')
+    p.add_argument('--world-sizes', nargs='+', type=int, default=[1, 2, 4])
+    p.add_argument('--model', default='lm', choices=['lm', 'transformer'])
+    p.add_argument('--vocab-sz', type=int, default=1024)
+    p.add_argument('--d-model', type=int, default=256)
+    p.add_argument('--n-layers', type=int, default=4)
+    p.add_argument('--n-heads', type=int, default=8)
+    p.add_argument('--bs', type=int, default=8, help='batch size per process')
+    p.add_argument('--sl', type=int, default=128)
+    p.add_argument('--accum-steps', type=int, default=1)
+    p.add_argument('--n-steps', type=int, default=10)
+    p.add_argument('--n-warmup', type=int, default=2)
+    p.add_argument('--bucket-cap-mb', type=float, default=25)
+    p.add_argument('--out', default=None, help='path to save results (.json or .csv)')
+    a = p.parse_args(args)
+    results = scaling_benchmark(a.world_sizes, a.model, a.vocab_sz, a.d_model, a.n_layers, a.n_heads, a.bs, a.sl,
+                                a.accum_steps, a.n_steps, a.n_warmup, a.bucket_cap_mb, verbose=True)
+    if a.out: save_results(results, a.out)
+
+if __name__ == '__main__' and 'ipykernel' not in sys.modules: main()
\ No newline at end of file
@@ -0,0 +1,143 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 07_export.ipynb (unless otherwise specified).
+
+__all__ = ['flatten_cache', 'unflatten_cache', 'trace_generation', 'export_generation', 'greedy_generate']
+
+# Cell
+import os, warnings
+import torch
+from torch import nn
+
+from .layers import *
+from .models import TransformerLM, Transformer
+
+# Cell
+def flatten_cache(cache, prefix=()):
+    "Returns paths (tuples of keys) and tensors stored in nested `cache` dict in deterministic order"
+    paths, tensors = [], []
+    for key in sorted(cache, key=str):
+        if isinstance(cache[key], dict):
+            p, t = flatten_cache(cache[key], prefix + (key,))
+            paths, tensors = paths + p, tensors + t
+        else:
+            paths.append(prefix + (key,))
+            tensors.append(cache[key])
+    return paths, tensors
+
+def unflatten_cache(paths, tensors):
+    "Builds nested cache dict from `paths` and `tensors` returned by `flatten_cache`"
+    cache = {}
+    for path, t in zip(paths, tensors):
+        d = cache
+        for key in path[:-1]: d = d.setdefault(key, {})
+        d[path[-1]] = t
+    return cache
+
+# Cell
+class _LMPrefill(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    def init_cache(self, x):
+        cache = {}
+        return self.model(x, cache=cache)[:, -1], cache
+    def forward(self, x):
+        logits, cache = self.init_cache(x)
+        return (logits, *flatten_cache(cache)[1])
+
+class _LMStep(nn.Module):
+    def __init__(self, model, paths):
+        super().__init__()
+        self.model, self.paths = model, paths
+    def forward(self, x, offset, *cache):
+        cache = unflatten_cache(self.paths, cache)
+        logits = self.model(x, cache=cache, offset=offset)[:, -1]
+        return (logits, *flatten_cache(cache)[1])
+
+class _Encoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    def init_cache(self, src, src_mask):
+        enc = self.model.encode(src, src_mask)
+        # decoding zero target tokens fills the cache with cross-attention keys and values and empty self-attention ones
+        cache = {}
+        self.model.decode(src.new_zeros(src.size(0), 0), enc, src_mask, cache=cache)
+        return enc, cache
+    def forward(self, src, src_mask):
+        enc, cache = self.init_cache(src, src_mask)
+        return (enc, *flatten_cache(cache)[1])
+
+class _EncDecStep(nn.Module):
+    def __init__(self, model, paths):
+        super().__init__()
+        self.model, self.paths = model, paths
+    def forward(self, x, offset, enc, src_mask, *cache):
+        cache = unflatten_cache(self.paths, cache)
+        logits = self.model.decode(x, enc, src_mask, cache=cache, offset=offset)[:, -1]
+        return (logits, *flatten_cache(cache)[1])
+
+def _prepare(model):
+    model.eval()
+    # causal masks and rotary tables are cached in buffers growing on demand, traced graphs slice ones covering all positions
+    device = next(model.parameters()).device
+    for m in model.modules():
+        if hasattr(m, 'causal_mask'): get_causal_mask(m, 1, model.max_seq_len, device)
+        if hasattr(m, 'rotary_cos'): get_rotary_tables(m, model.max_seq_len, device)
+
+@torch.no_grad()
+def trace_generation(model, inp, src_mask=None):
+    """
+    Traces `model` (`TransformerLM` or `Transformer` in eval mode) into TorchScript graphs for cached generation,
+    returns `(prefill, step)` for `TransformerLM` and `(encoder, step)` for `Transformer` (see above).
+    `inp` is example prompt or source ids [bs, sl], `src_mask` defaults to all True for `Transformer`
+    """
+    _prepare(model)
+    if isinstance(model, Transformer):
+        src_mask = default(src_mask, lambda: torch.ones_like(inp, dtype=torch.bool))
+        first, args = _Encoder(model), (inp, src_mask)
+        enc, cache = first.init_cache(*args)
+        paths, tensors = flatten_cache(cache)
+        step = _EncDecStep(model, paths), (inp[:, :1], torch.tensor(0), enc, src_mask, *tensors)
+    else:
+        assert isinstance(model, TransformerLM) and model.causal, 'only causal TransformerLM supports cached generation'
+        first, args = _LMPrefill(model), (inp,)
+        _, cache = first.init_cache(*args)
+        paths, tensors = flatten_cache(cache)
+        step = _LMStep(model, paths), (inp[:, -1:], torch.tensor(inp.size(1)), *tensors)
+    with warnings.catch_warnings():
+        # python branches on shapes are expected to be constant, e.g. step graph always processes a single token
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        return torch.jit.trace(first, args), torch.jit.trace(*step)
+
+def export_generation(model, inp, path, src_mask=None):
+    """
+    Traces `model` with `trace_generation` and saves the graphs to directory `path` as 'prefill.pt' ('encoder.pt'
+    for `Transformer`) and 'step.pt', they can be loaded with `torch.jit.load` (or `torch::jit::load` in C++)
+    """
+    first, step = trace_generation(model, inp, src_mask)
+    os.makedirs(path, exist_ok=True)
+    first.save(os.path.join(path, 'encoder.pt' if isinstance(model, Transformer) else 'prefill.pt'))
+    step.save(os.path.join(path, 'step.pt'))
+
+# Cell
+@torch.no_grad()
+def greedy_generate(first, step, inp, max_len=50, src_mask=None, bos_idx=2):
+    """
+    Greedy decoding of `max_len` tokens with graphs returned by `trace_generation` (or loaded exported ones),
+    `inp` is prompt for `TransformerLM` graphs and source for `Transformer` ones (`src_mask` is required then)
+    """
+    if src_mask is None:
+        logits, *cache = first(inp)
+        out, offset = inp, inp.size(1)
+    else:
+        enc, *cache = first(inp, src_mask)
+        out = inp.new_full((inp.size(0), 1), bos_idx)
+        logits, *cache = step(out, torch.tensor(0), enc, src_mask, *cache)
+        offset = 1
+    for i in range(max_len):
+        sample = logits.argmax(-1, keepdim=True)
+        out = torch.cat([out, sample], dim=1)
+        if i == max_len - 1: break
+        args = (sample, torch.tensor(offset + i)) + (() if src_mask is None else (enc, src_mask))
+        logits, *cache = step(*args, *cache)
+    return out
\ No newline at end of file
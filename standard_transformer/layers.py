@@ -1,23 +1,23 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 01_layers.ipynb (unless otherwise specified).
 
-__all__ = ['exists', 'default', 'expand_dim1', 'Residual', 'PostNorm', 'PreNorm', 'FeedForward', 'MASK_VAL',
-           'Attention', 'AdditiveAttention', 'AttnInProj', 'ScaledDotProdAttention', 'Attention',
-           'TransformerEncoderBlock', 'TransformerEncoder', 'TransformerDecoderBlock', 'TransformerDecoderBlockV2',
-           'TransformerDecoder', 'AbsolutePositionalEmbedding', 'FixedPositionalEmbedding', 'TransformerEmbedding']
+__all__ = ['exists', 'default', 'expand_dim1', 'Residual', 'PostNorm', 'PreNorm', 'FeedForward', 'mask_value',
+           'upcast_softmax', 'padding_attn_mask', 'segment_attn_mask', 'get_causal_mask', 'get_rotary_tables',
+           'apply_rotary', 'alibi_slopes', 'alibi_bias', 'fused_attention', 'chunked_attention', 'local_attn_mask',
+           'local_attention', 'Attention', 'AdditiveAttention', 'AttnInProj', 'ScaledDotProdAttention', 'Attention',
+           'pool_kv_heads', 'TransformerEncoderBlock', 'TransformerEncoder', 'evict_cache', 'truncate_cache',
+           'reorder_cache', 'TransformerDecoderBlock', 'TransformerDecoderBlockV2', 'TransformerDecoder',
+           'AbsolutePositionalEmbedding', 'FixedPositionalEmbedding', 'segment_positions', 'get_axial_dims',
+           'TransformerEmbedding']
 
 # Cell
 import torch
-from torch import nn, einsum
+from torch import nn, einsum, Tensor
 import torch.nn.functional as F
 from functools import partial, reduce
 from inspect import isfunction
 from operator import mul
-from fastai.basics import *
 from einops import rearrange, repeat
-try:
-    from axial_positional_embedding import AxialPositionalEmbedding, AxialPositionalEmbeddingImage
-except ImportError as e:
-    print(e)
+from torch.utils.checkpoint import checkpoint
 
 # Cell
 
@@ -34,6 +34,60 @@ def expand_dim1(x):
         return x[None, :]
     else: return x
 
+def _per_layer(val, depth):
+    "Per layer values: `val` is either a list of `depth` values or shared by all layers"
+    if not isinstance(val, (list, tuple)): return [val] * depth
+    assert len(val) == depth, f'expected {depth} per layer values, got {len(val)}'
+    return list(val)
+
+def _checkpoint(fn, *args):
+    "Runs `fn` without storing intermediate activations, they are recomputed during backward pass"
+    return checkpoint(fn, *args, use_reentrant=False)
+
+class _FusedQKV:
+    """
+    Mixin for modules with query, key and value projections fused into single `to_qkv` linear layer.
+    Checkpoints with separate `to_q` and `to_kv` projections are converted on loading
+    """
+    def _proj(self, x, start, end):
+        "Applies output features `start:end` of `to_qkv` to x, e.g. key-value part to cross-attention context"
+        if hasattr(self, 'to_kv'): return (self.to_q if start == 0 else self.to_kv)(x)
+        # quantized layers can't be sliced, whole projection is computed
+        if not isinstance(self.to_qkv, nn.Linear): return self.to_qkv(x)[..., start:end]
+        b = self.to_qkv.bias
+        return F.linear(x, self.to_qkv.weight[start:end], None if b is None else b[start:end])
+    def _init_qkv(self):
+        # initialized as separate query and key-value projections
+        d = self.to_qkv.in_features
+        with torch.no_grad():
+            nn.init.xavier_uniform_(self.to_qkv.weight[:d])
+            nn.init.xavier_uniform_(self.to_qkv.weight[d:])
+        if self.to_qkv.bias is not None: nn.init.constant_(self.to_qkv.bias, 0)
+    def split_qkv(self, keep_fused=False):
+        """
+        Moves query and key-value parts of `to_qkv` used by `_proj` into separate `to_q` and `to_kv` linear layers,
+        e.g. before quantization of cross-attention as quantized layers can't be sliced. If `keep_fused` only key-value
+        part is copied to `to_kv` and `to_qkv` is kept for inputs projected to queries, keys and values at once
+        """
+        d, w, b = self.to_qkv.in_features, self.to_qkv.weight, self.to_qkv.bias
+        def linear(rows):
+            lin = nn.Linear(d, w[rows].size(0), bias=b is not None).to(w.device, w.dtype)
+            with torch.no_grad():
+                lin.weight.copy_(w[rows])
+                if b is not None: lin.bias.copy_(b[rows])
+            return lin
+        self.to_kv = linear(slice(d, None))
+        if not keep_fused:
+            self.to_q = linear(slice(0, d))
+            del self.to_qkv
+        return self
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for p in ('weight', 'bias'):
+            q, kv = f'{prefix}to_q.{p}', f'{prefix}to_kv.{p}'
+            if q in state_dict and kv in state_dict and hasattr(self, 'to_qkv'):
+                state_dict[f'{prefix}to_qkv.{p}'] = torch.cat([state_dict.pop(q), state_dict.pop(kv)])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 # Cell
 class Residual(nn.Module):
     """Add skip-connection: out = x + sublayer(x)"""
@@ -87,10 +141,224 @@ class FeedForward(nn.Module):
             if p.dim()>1: nn.init.xavier_uniform_(p)
 
 # Cell
-MASK_VAL = -5e4
+def mask_value(t):
+    "Value filling masked attention scores `t`, the most negative finite value of their dtype so fp16/bf16 don't overflow"
+    return -torch.finfo(t.dtype).max
+
+def upcast_softmax(dots, dim=-1):
+    "Softmax computed in float32 for half precision inputs, result is cast back to dtype of `dots`"
+    return F.softmax(dots, dim, dtype=torch.float32).to(dots.dtype)
+
+def padding_attn_mask(mask):
+    "Converts boolean padding mask [bs, sl] to attention mask [bs, 1, 1, sl] broadcasted over heads and queries"
+    return None if mask is None else mask[:, None, None, :]
+
+def segment_attn_mask(segment_ids, context_segment_ids=None):
+    """
+    Block-diagonal attention mask [bs, 1, sl, cl] for packed sequences, tokens attend only within their segment.
+    `segment_ids` [bs, sl] number sequences packed into a row starting from 1, padding has segment id 0
+    """
+    k_ids = default(context_segment_ids, segment_ids)
+    return (segment_ids[:, None, :, None] == k_ids[:, None, None, :]) & (k_ids != 0)[:, None, None, :]
+
+def _repeat_kv(t, n_heads):
+    "Repeats key/value heads of `t` [bs, n_kv_heads, cl, d_head] for each query head of the group sharing them"
+    n_kv = t.size(1)
+    return t if n_kv == n_heads else t[:, :, None].expand(-1, -1, n_heads // n_kv, -1, -1).flatten(1, 2)
+
+def get_causal_mask(module, sl, cl, device):
+    """
+    Returns boolean mask [sl, cl] which is True at positions queries can't attend to, queries correspond
+    to the last `sl` of `cl` positions. The mask is cached in `module.causal_mask` buffer which grows on demand
+    """
+    mask = module.causal_mask
+    if mask.size(0) < cl or mask.device != device:
+        n = max(cl, mask.size(0))
+        mask = module.causal_mask = torch.ones(n, n, dtype=torch.bool, device=device).triu_(1)
+    return mask[cl-sl:cl, :cl]
 
 # Cell
-class Attention(nn.Module):
+def get_rotary_tables(module, n, device):
+    """
+    Returns cos and sin [n, d_head] of rotary encodings of positions 0..n-1, pairs of features (i, i + d_head/2)
+    are rotated by angle pos*theta_i. Tables are cached in `module.rotary_cos` and `module.rotary_sin` buffers
+    """
+    cos = module.rotary_cos
+    if cos.size(0) < n or cos.device != device:
+        d_head = module.d_model // module.n_heads
+        inv_freq = 1. / (10000 ** (torch.arange(0, d_head, 2, device=device).float() / d_head))
+        freqs = torch.arange(max(n, cos.size(0)), device=device).float()[:, None] * inv_freq
+        freqs = torch.cat([freqs, freqs], dim=-1)
+        module.rotary_cos, module.rotary_sin = freqs.cos(), freqs.sin()
+    return module.rotary_cos[:n], module.rotary_sin[:n]
+
+def apply_rotary(x, cos, sin):
+    "Rotates features of `x` [..., n, d_head] by rotary tables `cos` and `sin` [n, d_head]"
+    x1, x2 = x.chunk(2, dim=-1)
+    return (x * cos + torch.cat([-x2, x1], dim=-1) * sin).to(x.dtype)
+
+def alibi_slopes(n_heads):
+    "Per head slopes of ALiBi biases, geometric sequence starting at 2^(-8/n_heads) (interleaved if n_heads isn't a power of 2)"
+    pow2 = lambda n: [2 ** (-8 * (i + 1) / n) for i in range(n)]
+    closest = 2 ** (n_heads.bit_length() - 1)
+    return torch.tensor(pow2(closest) + pow2(2 * closest)[0::2][:n_heads - closest])
+
+def alibi_bias(slopes, sl, cl, dtype=None):
+    "ALiBi bias [n_heads, sl, cl] penalizing scores by slope * distance, queries correspond to the last `sl` of `cl` positions"
+    pos = torch.arange(cl, device=slopes.device)
+    dist = (pos[cl-sl:, None] - pos[None, :]).abs()
+    return (-slopes[:, None, None] * dist).to(default(dtype, slopes.dtype))
+
+# Cell
+def fused_attention(q, k, v, attn_mask=None, dropout_p=0., is_causal=False, bias=None):
+    """
+    Dispatches to fused `F.scaled_dot_product_attention` (falls back to einsum implementation for torch<2.0).
+    q, k, v have shape [bs, n_heads, sl, d_head], boolean attn_mask is False at positions not to attend to,
+    float `bias` broadcastable to [bs, n_heads, sl, cl] (e.g. ALiBi) is added to attention scores
+    """
+    if exists(bias):
+        assert not is_causal, 'causal masking should be included into attn_mask when bias is used'
+        if exists(attn_mask):
+            fill = torch.zeros(attn_mask.shape, dtype=bias.dtype, device=bias.device).masked_fill_(~attn_mask, mask_value(bias))
+            bias = bias + fill
+        attn_mask = bias.to(q.dtype)
+    elif exists(attn_mask):
+        # fully masked rows attend uniformly as with `mask_value` filling instead of producing nan
+        attn_mask = attn_mask | ~attn_mask.any(-1, keepdim=True)
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal)
+    dots = torch.einsum('bhid,bhjd->bhij', q * q.size(-1)**-0.5, k)
+    if is_causal: attn_mask = torch.ones(dots.shape[-2:], dtype=torch.bool, device=q.device).tril_()
+    if exists(attn_mask):
+        if attn_mask.dtype == torch.bool: dots.masked_fill_(~attn_mask, mask_value(dots))
+        else: dots = dots + attn_mask
+    attn = F.dropout(upcast_softmax(dots), p=dropout_p, training=dropout_p > 0)
+    return torch.einsum('bhij,bhjd->bhid', attn, v)
+
+# Cell
+def _mask_block(mask, i0, i1, j0, j1):
+    "Slices rows i0:i1 and columns j0:j1 of (possibly broadcasted) mask"
+    if mask.size(-2) > 1: mask = mask[..., i0:i1, :]
+    return mask[..., j0:j1] if mask.size(-1) > 1 else mask
+
+def _attend_query_chunk(q, k, v, attn_mask, causal, pos_offset, q_start, kv_chunk_size, dropout_p, slopes=None):
+    # online softmax: running max `m`, normaliser `l` and weighted sum of values `acc` over key chunks,
+    # kept in float32 for half precision inputs
+    i, j = q.size(-2), k.size(-2)
+    m = q.new_full(q.shape[:-1], float('-inf'), dtype=torch.float32)
+    l = q.new_zeros(q.shape[:-1], dtype=torch.float32)
+    acc = torch.zeros_like(q, dtype=torch.float32)
+    # query at row r has position r + pos_offset, with causal masking it attends to keys up to that position
+    rows = torch.arange(q_start, q_start+i, device=q.device)[:, None] + pos_offset
+    for j0 in range(0, j, kv_chunk_size):
+        if causal and j0 > q_start + i - 1 + pos_offset: break
+        j1 = min(j0 + kv_chunk_size, j)
+        dots = torch.einsum('bhid,bhjd->bhij', q, k[:, :, j0:j1]).float()
+        if exists(attn_mask):
+            dots.masked_fill_(~_mask_block(attn_mask, q_start, q_start+i, j0, j1), mask_value(dots))
+        cols = torch.arange(j0, j1, device=q.device)[None, :]
+        if causal: dots.masked_fill_(cols > rows, mask_value(dots))
+        if exists(slopes): dots -= slopes.float()[:, None, None] * (cols - rows).abs()
+        m_new = torch.maximum(m, dots.amax(-1))
+        # clamping avoids slow exp underflow for masked positions, exp(-80) is negligible
+        p = torch.exp((dots - m_new[..., None]).clamp_(min=-80))
+        corr = torch.exp(m - m_new)
+        l = l * corr + p.sum(-1)
+        p = F.dropout(p, p=dropout_p, training=dropout_p > 0)
+        acc = acc * corr[..., None] + torch.einsum('bhij,bhjd->bhid', p.to(v.dtype), v[:, :, j0:j1]).float()
+        m = m_new
+    return (acc / l[..., None]).to(q.dtype)
+
+def chunked_attention(q, k, v, attn_mask=None, causal=False, chunk_size=1024, kv_chunk_size=None, dropout_p=0.,
+                      alibi_slopes=None):
+    """
+    Memory efficient attention processing queries in chunks of `chunk_size` and keys in chunks of `kv_chunk_size`
+    (all keys at once if None) with online softmax, so only [chunk_size x kv_chunk_size] scores are materialized.
+    When gradients are required query chunks are recomputed in backward pass instead of storing their activations.
+    q, k, v have shape [bs, n_heads, sl, d_head], boolean attn_mask is False at positions not to attend to,
+    ALiBi biases with per head `alibi_slopes` are computed for each block
+    """
+    i, j = q.size(-2), k.size(-2)
+    kv_chunk_size = default(kv_chunk_size, j)
+    # with cached keys queries correspond to the last i positions
+    pos_offset = j - i
+    q = q * q.size(-1)**-0.5
+    recompute = torch.is_grad_enabled() and any(t.requires_grad for t in (q, k, v))
+    out = []
+    for i0 in range(0, i, chunk_size):
+        args = (q[:, :, i0:i0+chunk_size], k, v, attn_mask, causal, pos_offset, i0, kv_chunk_size, dropout_p, alibi_slopes)
+        out.append(_checkpoint(_attend_query_chunk, *args) if recompute else _attend_query_chunk(*args))
+    return torch.cat(out, dim=-2) if out else q
+
+# Cell
+def local_attn_mask(sl, cl, window_size, causal=False, n_global=0, device=None):
+    """
+    Boolean mask [sl, cl] of sliding window attention, True where queries (the last `sl` of `cl` positions) attend:
+    keys within `window_size` positions (only preceding ones if `causal`) and the first `n_global` global tokens,
+    which attend to all keys as well
+    """
+    i = torch.arange(cl-sl, cl, device=device)[:, None]
+    j = torch.arange(cl, device=device)[None, :]
+    mask = (i - j <= window_size) & (j - i <= (0 if causal else window_size))
+    if n_global:
+        is_global = (i < n_global) | (j < n_global)
+        mask |= is_global & (j <= i) if causal else is_global
+    return mask
+
+def _mask_windows(mask, idx, nb, w):
+    "Gathers key columns `idx` [nb, kw] of (possibly broadcasted) mask [..., sl, cl] for `nb` query blocks of size `w`"
+    if mask.size(-2) == 1: return mask[..., idx][..., 0, :, None, :]
+    n = nb * w - mask.size(-2)
+    if n: mask = torch.cat([mask, mask.new_ones(*mask.shape[:-2], n, mask.size(-1))], dim=-2)
+    mask = mask.reshape(*mask.shape[:-2], nb, w, mask.size(-1))
+    return mask.gather(-1, idx[:, None, :].expand(*mask.shape[:-1], idx.size(-1)))
+
+def local_attention(q, k, v, window_size, attn_mask=None, causal=False, n_global=0, dropout_p=0., alibi_slopes=None):
+    """
+    Sliding window attention (see `local_attn_mask`) computed blockwise: queries in blocks of `window_size` attend to
+    keys of their own and neighbouring blocks, so compute and memory are O(sl * window_size), global tokens add
+    O(sl * n_global). q, k, v have shape [bs, n_heads, sl, d_head], boolean attn_mask is False at positions not to attend to
+    """
+    bs, h, n, dh = q.shape
+    w, g, device = window_size, n_global, q.device
+    nb, kw = -(-n // w), (2 if causal else 3) * window_size
+    q = q * dh**-0.5
+    qb = F.pad(q, (0, 0, 0, nb*w - n)).view(bs, h, nb, w, dh)
+    # block b attends to keys from (b-1)*w up to (b+1)*w ((b+2)*w if not causal), viewed as [bs, h, nb, kw, dh]
+    pad = (0, 0, w, nb*w - n + (0 if causal else w))
+    kb, vb = [F.pad(t, pad).unfold(2, kw, w).transpose(-1, -2) for t in (k, v)]
+    qpos = torch.arange(nb*w, device=device).view(nb, w)
+    kpos = torch.arange(nb, device=device)[:, None] * w - w + torch.arange(kw, device=device)
+    rel = kpos[:, None, :] - qpos[..., None]
+    # global keys are attended separately
+    allowed = (rel >= -w) & (rel <= (0 if causal else w)) & ((kpos >= g) & (kpos < n))[:, None, :]
+    dots = torch.einsum('bhnid,bhnjd->bhnij', qb, kb)
+    if exists(alibi_slopes): dots = dots - (alibi_slopes[:, None, None, None] * rel.abs()).to(dots.dtype)
+    dots = dots.masked_fill(~allowed, mask_value(dots))
+    if exists(attn_mask): dots.masked_fill_(~_mask_windows(attn_mask, kpos.clamp(0, n-1), nb, w), mask_value(dots))
+    if g:
+        gpos = torch.arange(g, device=device)
+        dots_g = torch.einsum('bhnid,bhjd->bhnij', qb, k[:, :, :g])
+        if exists(alibi_slopes):
+            dots_g = dots_g - (alibi_slopes[:, None, None, None] * (qpos[..., None] - gpos).abs()).to(dots_g.dtype)
+        if causal: dots_g.masked_fill_(gpos > qpos[..., None], mask_value(dots_g))
+        if exists(attn_mask): dots_g.masked_fill_(~_mask_windows(attn_mask, gpos.expand(nb, g), nb, w), mask_value(dots_g))
+        dots = torch.cat([dots, dots_g], dim=-1)
+    attn = F.dropout(upcast_softmax(dots), p=dropout_p, training=dropout_p > 0)
+    out = torch.einsum('bhnij,bhnjd->bhnid', attn[..., :kw], vb)
+    if g: out = out + torch.einsum('bhnij,bhjd->bhnid', attn[..., kw:], v[:, :, :g])
+    out = out.reshape(bs, h, nb*w, dh)[:, :, :n]
+    if not g: return out
+    # global queries attend to all keys
+    dots = torch.einsum('bhid,bhjd->bhij', q[:, :, :g], k)
+    if exists(alibi_slopes): dots = dots + alibi_bias(alibi_slopes, n, n, dots.dtype)[:, :g]
+    if causal: dots.masked_fill_(torch.arange(n, device=device) > gpos[:, None], mask_value(dots))
+    if exists(attn_mask): dots.masked_fill_(~_mask_block(attn_mask, 0, g, 0, n), mask_value(dots))
+    attn = F.dropout(upcast_softmax(dots), p=dropout_p, training=dropout_p > 0)
+    return torch.cat([torch.einsum('bhij,bhjd->bhid', attn, v), out[:, :, g:]], dim=2)
+
+# Cell
+class Attention(_FusedQKV, nn.Module):
     """Standard attention module"""
     def __init__(self,
                  dim,
@@ -106,20 +374,18 @@ class Attention(nn.Module):
         self.n_heads = n_heads
         self.scale = (dim//n_heads) ** -0.5
 
-        self.to_q = nn.Linear(dim, dim, bias=bias)
-        self.to_kv = nn.Linear(dim, dim * 2, bias=bias)
+        self.to_qkv = nn.Linear(dim, dim * 3, bias=bias)
         self.dropout = nn.Dropout(dropout)
 
         self.to_out = nn.Linear(dim, dim)
+        self.register_buffer('causal_mask', torch.empty(0, 0, dtype=torch.bool), persistent=False)
 
         self._init()
 
     def forward(self, x, context = None, mask = None, context_mask = None, store_attention=False):
-        b, n, _, h, device = *x.shape, self.n_heads, x.device
-        kv_input = default(context, x)
-
-        q = self.to_q(x)
-        kv = self.to_kv(kv_input).chunk(2, dim = -1)
+        b, n, d, h, device = *x.shape, self.n_heads, x.device
+        if exists(context): q, kv = self._proj(x, 0, d), self._proj(context, d, 3*d).chunk(2, dim = -1)
+        else: q, *kv = self.to_qkv(x).chunk(3, dim = -1)
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (q, *kv))
         # boolean input_mask is False at positions not to attend to
@@ -133,18 +399,15 @@ class Attention(nn.Module):
             input_mask = q_mask * k_mask
         # classic dot-product attention
         dots = torch.einsum('bhid,bhjd->bhij', q*self.scale, k)
-        # might need to tune MASK_VAL for fp16 to work
         if exists(input_mask):
-            dots.masked_fill_(~input_mask, MASK_VAL)
+            dots.masked_fill_(~input_mask, mask_value(dots))
             del input_mask
 
         if self.causal:
             i, j = dots.shape[-2:]
-            mask = torch.ones((i, j), device = device).triu_(j - i + 1).bool()
-            dots.masked_fill_(mask, MASK_VAL)
-            del mask
+            dots.masked_fill_(get_causal_mask(self, i, j, device), mask_value(dots))
 
-        attn = F.softmax(dots, -1)
+        attn = upcast_softmax(dots)
         if self.store_attention: # and not self.training
             self.attention = attn.detach().cpu()
         attn = self.dropout(attn)
@@ -156,17 +419,12 @@ class Attention(nn.Module):
         return out
 
     def _init(self):
-        nn.init.xavier_uniform_(self.to_q.weight)
-        nn.init.xavier_uniform_(self.to_kv.weight)
+        self._init_qkv()
         nn.init.xavier_uniform_(self.to_out.weight)
-        if getattr(self.to_q, 'bias', None) is not None:
-            nn.init.constant_(self.to_q.bias, 0)
-        if getattr(self.to_kv, 'bias', None) is not None:
-            nn.init.constant_(self.to_kv.bias, 0)
         nn.init.constant_(self.to_out.bias, 0)
 
 # Cell
-class AdditiveAttention(nn.Module):
+class AdditiveAttention(_FusedQKV, nn.Module):
     """Additive attention combining self and cross attention"""
     def __init__(self,
                  dim,
@@ -174,54 +432,83 @@ class AdditiveAttention(nn.Module):
                  causal = False,
                  mask = None,
                  dropout=0.1,
-                 bias=True):
+                 bias=True,
+                 backend='einsum',
+                 chunk_size=1024,
+                 kv_chunk_size=None):
         super().__init__()
+        assert backend in ('einsum', 'sdpa', 'chunked')
         self.causal = causal
         self.store_attention = False
         self.mask = mask #??
         self.n_heads = n_heads
+        self.backend = backend
+        self.chunk_size, self.kv_chunk_size = chunk_size, kv_chunk_size
         self.scale = (dim//n_heads) ** -0.5
 
-        self.to_q = nn.Linear(dim, dim, bias = bias)
-        self.to_kv = nn.Linear(dim, dim * 2, bias = bias)
+        self.to_qkv = nn.Linear(dim, dim * 3, bias = bias)
         self.dropout = nn.Dropout(dropout)
 
         self.to_out = nn.Linear(dim, dim)
+        self.register_buffer('causal_mask', torch.empty(0, 0, dtype=torch.bool), persistent=False)
 
         self._init()
 
-    def forward(self, x, context = None, mask = None, context_mask = None, store_attention=False):
+    def forward(self, x, context = None, mask = None, context_mask = None, store_attention=False, cache=None,
+                attn_mask = None, context_attn_mask = None):
         b, n, d, h, device = *x.shape, self.n_heads, x.device
         context = default(context, torch.empty(b, 0, d, dtype=x.dtype, device=device))
-        kv_input = torch.cat([x, context], dim=-2)
 
-        q = self.to_q(x)
-        kv = self.to_kv(kv_input).chunk(2, dim = -1)
+        q, k, v = self.to_qkv(x).chunk(3, dim = -1)
+        if exists(cache):
+            # self-attention keys are appended to cache, context keys are computed once
+            if 'k' in cache:
+                k, v = torch.cat([cache['k'], k], dim=-2), torch.cat([cache['v'], v], dim=-2)
+            cache['k'], cache['v'] = k, v
+            if 'context_k' not in cache:
+                cache['context_k'], cache['context_v'] = self._proj(context, d, 3*d).chunk(2, dim = -1)
+            context_k, context_v = cache['context_k'], cache['context_v']
+        else: context_k, context_v = self._proj(context, d, 3*d).chunk(2, dim = -1)
+        kv = torch.cat([k, context_k], dim=-2), torch.cat([v, context_v], dim=-2)
+        m = kv[0].size(-2) - context.size(-2) # number of self-attention keys
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (q, *kv))
 
-        # boolean input_mask is False at positions not to attend to
+        # boolean input_mask is False at positions not to attend to; outputs at padded query positions
+        # are not used, so only keys are masked
+        if exists(cache) and exists(mask):
+            cache['mask'] = torch.cat([cache.get('mask', mask.new_ones(b, m-n)), mask], dim=1)
+            attn_mask = padding_attn_mask(cache['mask'])
+        attn_mask = default(attn_mask, padding_attn_mask(mask))
+        context_attn_mask = default(context_attn_mask, padding_attn_mask(context_mask))
         input_mask = None
-        if any(map(exists, (mask, context_mask))):
-            q_mask = default(mask, lambda: torch.ones((b, n), device = device).bool())
-            self_mask = q_mask[:, None, :, None] * q_mask[:, None, None, :]
-            if context.size(-2) != 0:
-                k_mask = default(context_mask, lambda: torch.ones((b, context.shape[-2]), device = device).bool())
-                cross_mask = q_mask[:, None, :, None] * k_mask[:, None, None, :]
-            else: cross_mask = torch.empty(0, dtype=self_mask.dtype, device=device)
+        if any(map(exists, (attn_mask, context_attn_mask))):
+            self_mask = default(attn_mask, lambda: torch.ones((b, 1, 1, m), dtype=torch.bool, device=device))
+            cross_mask = default(context_attn_mask,
+                                 lambda: torch.ones((b, 1, 1, context.size(-2)), dtype=torch.bool, device=device))
+            if self_mask.size(-2) != cross_mask.size(-2):
+                self_mask, cross_mask = self_mask.expand(-1, -1, n, -1), cross_mask.expand(-1, -1, n, -1)
             input_mask = torch.cat([self_mask, cross_mask], dim=-1)
+        if self.backend != 'einsum' and not self.store_attention:
+            if self.causal:
+                causal_mask = ~get_causal_mask(self, n, m, device)
+                causal_mask = torch.cat([causal_mask, causal_mask.new_ones(n, k.size(-2) - m)], dim=-1)
+                input_mask = causal_mask if input_mask is None else input_mask & causal_mask
+            dropout_p = self.dropout.p if self.training else 0.
+            if self.backend == 'sdpa': out = fused_attention(q, k, v, input_mask, dropout_p=dropout_p)
+            else: out = chunked_attention(q, k, v, input_mask, chunk_size=self.chunk_size,
+                                          kv_chunk_size=self.kv_chunk_size, dropout_p=dropout_p)
+            return self.to_out(rearrange(out, 'b h n d -> b n (h d)'))
         # classic scaled dot-product attention
         dots = torch.einsum('bhid,bhjd->bhij', q * self.scale, k)
-        # might need to tune MASK_VAL for fp16 to work
         if exists(input_mask):
-            dots.masked_fill_(~input_mask, MASK_VAL)
+            dots.masked_fill_(~input_mask, mask_value(dots))
             del input_mask
 
         if self.causal:
-            i, j = torch.triu_indices(n, n, 1)
-            dots[:,:,i,j] = MASK_VAL
+            dots[..., :m].masked_fill_(get_causal_mask(self, n, m, device), mask_value(dots))
 
-        attn = F.softmax(dots, -1)
+        attn = upcast_softmax(dots)
         if self.store_attention: # and not self.training
             self.attention = attn.detach().cpu()
         attn = self.dropout(attn)
@@ -232,60 +519,143 @@ class AdditiveAttention(nn.Module):
         return out
 
     def _init(self):
-        nn.init.xavier_uniform_(self.to_q.weight)
-        nn.init.xavier_uniform_(self.to_kv.weight)
+        self._init_qkv()
         nn.init.xavier_uniform_(self.to_out.weight)
-        if getattr(self.to_q, 'bias', None) is not None:
-            nn.init.constant_(self.to_q.bias, 0)
-        if getattr(self.to_kv, 'bias', None) is not None:
-            nn.init.constant_(self.to_kv.bias, 0)
         nn.init.constant_(self.to_out.bias, 0)
 
 # Cell
-class AttnInProj(nn.Module):
-    """Computes q, k, v from input x and [optional] context"""
-    def __init__(self, d_model:int, bias:bool=False):
+class AttnInProj(_FusedQKV, nn.Module):
+    """
+    Computes q, k, v from input x and [optional] context
+    Projections are fused into `to_qkv` layer: for self-attention q, k, v are computed by a single matmul,
+    for cross-attention its query part is applied to x and key-value part to context.
+    If `cache` dict is passed keys and values are stored in it: for self-attention new k, v are
+    appended to the cached ones, for cross-attention k, v are computed from context only once.
+    Keys and values have `d_kv` features (`d_model` by default), fewer for grouped-query attention
+    """
+    def __init__(self, d_model:int, bias:bool=False, d_kv:int=None):
         super().__init__()
-        self.to_q = nn.Linear(d_model, d_model, bias=bias)
-        self.to_kv = nn.Linear(d_model, 2*d_model, bias=bias)
-    def forward(self, x, context=None):
-        context = default(context, x)
-        q = self.to_q(x)
-        k, v = self.to_kv(context).chunk(2, -1)
+        self.d_model, self.d_kv = d_model, default(d_kv, d_model)
+        self.to_qkv = nn.Linear(d_model, d_model + 2*self.d_kv, bias=bias)
+    def forward(self, x, context=None, cache=None):
+        d, d_kv = self.d_model, self.d_kv
+        if exists(context):
+            q = self._proj(x, 0, d)
+            if exists(cache) and 'k' in cache: return q, cache['k'], cache['v']
+            k, v = self._proj(context, d, d + 2*d_kv).chunk(2, -1)
+        else:
+            q, k, v = self.to_qkv(x).split([d, d_kv, d_kv], -1)
+            if exists(cache) and 'k' in cache:
+                k = torch.cat([cache['k'], k], dim=1)
+                v = torch.cat([cache['v'], v], dim=1)
+        if exists(cache): cache['k'], cache['v'] = k, v
         return q, k, v
 
 # Cell
 #TODO make sure store_attention works
-class ScaledDotProdAttention(Module):
-
-    def __init__(self, d_model, n_heads, causal=False, dropout=0., store_attention:bool=False):
-        store_attr()
+class ScaledDotProdAttention(nn.Module):
+    """
+    Multihead scaled dot-product attention
+    backend: str from {'einsum', 'sdpa', 'chunked'} - 'sdpa' uses fused `F.scaled_dot_product_attention` kernels
+        which don't materialize attention matrix, 'chunked' processes queries in chunks of `chunk_size` and
+        keys in chunks of `kv_chunk_size` using online softmax (einsum is used when store_attention is True)
+    pos_enc: str from {None, 'rotary', 'alibi'} - relative position encoding of queries and keys, positions are
+        indices in the key context with queries corresponding to the last sl of cl positions
+    window_size: int - if given queries only attend to keys within `window_size` positions and `n_global` first
+        tokens (see `local_attn_mask`), computed blockwise by `local_attention` unless keys are cached
+        or store_attention is True, then the backend attends to the last window of keys with local mask
+    n_kv_heads: int - number of key/value heads (n_heads by default), each one is shared by a group of
+        n_heads // n_kv_heads query heads (1 for multi-query attention); keys and values have n_kv_heads * d_head features
+    """
+    def __init__(self, d_model, n_heads, causal=False, dropout=0., store_attention:bool=False, backend:str='einsum',
+                 chunk_size:int=1024, kv_chunk_size:int=None, pos_enc:str=None, window_size:int=None, n_global:int=0,
+                 n_kv_heads:int=None):
+        super().__init__()
+        assert backend in ('einsum', 'sdpa', 'chunked')
+        assert pos_enc in (None, 'rotary', 'alibi')
+        self.n_kv_heads = default(n_kv_heads, n_heads)
+        assert n_heads % self.n_kv_heads == 0, 'n_heads should be divisible by n_kv_heads'
+        self.d_model, self.n_heads, self.causal, self.store_attention = d_model, n_heads, causal, store_attention
+        self.backend, self.chunk_size, self.kv_chunk_size, self.pos_enc = backend, chunk_size, kv_chunk_size, pos_enc
+        self.window_size, self.n_global = window_size, n_global
         self.scale = (d_model//n_heads)**-0.5
         self.dropout = nn.Dropout(dropout)
+        self.register_buffer('causal_mask', torch.empty(0, 0, dtype=torch.bool), persistent=False)
+        if pos_enc == 'rotary':
+            self.register_buffer('rotary_cos', torch.empty(0, d_model//n_heads), persistent=False)
+            self.register_buffer('rotary_sin', torch.empty(0, d_model//n_heads), persistent=False)
+        if pos_enc == 'alibi':
+            self.register_buffer('alibi_slopes', alibi_slopes(n_heads), persistent=False)
 
     def forward(self, q, k, v, attn_mask=None):
         device = q.device
         bs, sl, d, cl = *q.size(), k.size(1)
+        h, n_kv, dh = self.n_heads, self.n_kv_heads, d // self.n_heads
 
-        q = q.view(bs, sl, self.n_heads, -1).transpose(1, 2)
-        k = k.view(bs, cl, self.n_heads, -1).transpose(1, 2)
-        v = v.view(bs, cl, self.n_heads, -1).transpose(1, 2)
-        # classic dot-product attention
-        dots = torch.einsum('bhid,bhjd->bhij', q*self.scale, k)
+        q = q.view(bs, sl, h, dh).transpose(1, 2)
+        k = k.view(bs, cl, n_kv, dh).transpose(1, 2)
+        v = v.view(bs, cl, n_kv, dh).transpose(1, 2)
+        if self.pos_enc == 'rotary':
+            cos, sin = get_rotary_tables(self, cl, device)
+            q, k = apply_rotary(q, cos[cl-sl:], sin[cl-sl:]), apply_rotary(k, cos, sin)
+        if exists(self.window_size):
+            if sl == cl and not self.store_attention:
+                slopes = self.alibi_slopes if self.pos_enc == 'alibi' else None
+                k, v = _repeat_kv(k, h), _repeat_kv(v, h)
+                out = local_attention(q, k, v, self.window_size, attn_mask, causal=self.causal, n_global=self.n_global,
+                                      dropout_p=self.dropout.p if self.training else 0., alibi_slopes=slopes)
+                return out.transpose(1, 2).reshape(bs, sl, d)
+            k, v, attn_mask = self._local_context(sl, cl, k, v, attn_mask)
+            cl = k.size(-2)
+        if self.backend == 'sdpa' and not self.store_attention:
+            k, v = _repeat_kv(k, h), _repeat_kv(v, h)
+            return self._fused_attention(q, k, v, attn_mask).transpose(1, 2).reshape(bs, sl, d)
+        if self.backend == 'chunked' and not self.store_attention:
+            k, v = _repeat_kv(k, h), _repeat_kv(v, h)
+            slopes = self.alibi_slopes if self.pos_enc == 'alibi' else None
+            out = chunked_attention(q, k, v, attn_mask, causal=self.causal, chunk_size=self.chunk_size,
+                                    kv_chunk_size=self.kv_chunk_size, dropout_p=self.dropout.p if self.training else 0.,
+                                    alibi_slopes=slopes)
+            return out.transpose(1, 2).reshape(bs, sl, d)
+        # classic dot-product attention, query heads are grouped to share key/value heads without copying them
+        dots = torch.einsum('bkgid,bkjd->bkgij', (q*self.scale).view(bs, n_kv, h // n_kv, sl, dh), k).view(bs, h, sl, cl)
+        if self.pos_enc == 'alibi': dots = dots + alibi_bias(self.alibi_slopes, sl, cl, dots.dtype)
 
         if exists(attn_mask):
-            dots.masked_fill_(~input_mask, MASK_VAL)
-            del input_mask
+            dots.masked_fill_(~attn_mask, mask_value(dots))
+            del attn_mask
         if self.causal:
-            i, j = torch.triu_indices(sl, sl, 1)
-            dots[:,:,i,j] = MASK_VAL
+            # with cached keys queries correspond to the last sl positions
+            dots.masked_fill_(get_causal_mask(self, sl, cl, device), mask_value(dots))
 
-        attn = F.softmax(dots, -1)
+        attn = upcast_softmax(dots)
         if self.store_attention: self.attention = attn.detach().cpu()
 
         attn = self.dropout(attn)
-        out = torch.einsum('bhij, bhjd -> bihd', attn, v)
-        return out.contiguous().view(bs, sl, -1)
+        out = torch.einsum('bkgij, bkjd -> bikgd', attn.view(bs, n_kv, h // n_kv, sl, cl), v)
+        return out.reshape(bs, sl, d)
+
+    def _fused_attention(self, q, k, v, attn_mask):
+        sl, cl = q.size(-2), k.size(-2)
+        dropout_p = self.dropout.p if self.training else 0.
+        bias = alibi_bias(self.alibi_slopes, sl, cl, q.dtype) if self.pos_enc == 'alibi' else None
+        # single query attends to all cached keys
+        causal = bool(self.causal and sl > 1)
+        if causal and (exists(attn_mask) or exists(bias) or sl != cl):
+            causal_mask = ~get_causal_mask(self, sl, cl, q.device)
+            attn_mask = causal_mask if attn_mask is None else attn_mask & causal_mask
+            causal = False
+        return fused_attention(q, k, v, attn_mask, dropout_p=dropout_p, is_causal=causal, bias=bias)
+
+    def _local_context(self, sl, cl, k, v, attn_mask):
+        "Keys, values and attention mask restricted to windows of queries corresponding to the last `sl` of `cl` positions"
+        local_mask = local_attn_mask(sl, cl, self.window_size, self.causal, self.n_global, k.device)
+        if not self.n_global:
+            # earlier keys are out of all windows, slicing keeps relative positions of the rest
+            start = max(cl - sl - self.window_size, 0)
+            k, v, local_mask = k[:, :, start:], v[:, :, start:], local_mask[:, start:]
+            if exists(attn_mask) and attn_mask.size(-1) > 1: attn_mask = attn_mask[..., start:]
+        return k, v, local_mask if attn_mask is None else attn_mask & local_mask
 
 # Cell
 class Attention(nn.Module):
@@ -300,21 +670,40 @@ class Attention(nn.Module):
                  dropout:float=0.1,
                  out_dropout:float=None,
                  bias:bool=False,
-                 store_attention:bool=False):
+                 store_attention:bool=False,
+                 backend:str='einsum',
+                 chunk_size:int=1024,
+                 kv_chunk_size:int=None,
+                 pos_enc:str=None,
+                 window_size:int=None,
+                 n_global:int=0,
+                 n_kv_heads:int=None):
         super().__init__()
-        store_attr('causal, mask, n_heads, bias')
+        self.causal, self.mask, self.n_heads, self.bias = causal, mask, n_heads, bias
         out_dropout = default(out_dropout, dropout)
-        self.in_proj = AttnInProj(d_model, bias=bias)
-        self.attn = ScaledDotProdAttention(d_model, n_heads, causal=causal,
-                                           dropout=dropout, store_attention=store_attention)
+        self.in_proj = AttnInProj(d_model, bias=bias, d_kv=d_model // n_heads * default(n_kv_heads, n_heads))
+        self.attn = ScaledDotProdAttention(d_model, n_heads, causal=causal, dropout=dropout,
+                                           store_attention=store_attention, backend=backend,
+                                           chunk_size=chunk_size, kv_chunk_size=kv_chunk_size, pos_enc=pos_enc,
+                                           window_size=window_size, n_global=n_global, n_kv_heads=n_kv_heads)
         self.out_proj = nn.Linear(d_model, d_model, bias=bias)
         self.dropout = nn.Dropout(out_dropout)
         self._init()
 
-    def forward(self, x, context = None, mask = None, context_mask = None):
-        q, k, v = self.in_proj(x, context)
+    def forward(self, x, context = None, mask = None, context_mask = None, cache = None, attn_mask = None):
+        """
+        `mask` and `context_mask` are boolean padding masks [bs, sl] and [bs, cl], precomputed boolean `attn_mask`
+        broadcastable to [bs, n_heads, sl, cl] (e.g. shared by all layers) takes precedence over them
+        """
+        q, k, v = self.in_proj(x, context, cache=cache)
+        if exists(cache) and not exists(context):
+            # cached self-attention: keys span previous steps as well
+            if exists(mask):
+                prev = cache.get('mask', mask.new_ones(mask.size(0), k.size(1)-mask.size(1)))
+                context_mask = cache['mask'] = torch.cat([prev, mask], dim=1)
+            context = k
 
-        attn_mask = self._make_input_mask(mask, context_mask, x, context)
+        attn_mask = default(attn_mask, lambda: self._make_input_mask(mask, context_mask, context))
         out = self.attn(q, k, v, attn_mask)
 
         out = self.out_proj(out)
@@ -324,18 +713,30 @@ class Attention(nn.Module):
         [nn.init.xavier_uniform_(w) for w in self.parameters() if w.dim()>1]
         if self.bias:
             [nn.init.constant_(b, 0) for b in self.parameters() if b.dim()==1]
+        self.in_proj._init_qkv()
 
-    def _make_input_mask(self, mask, context_mask, x, context):
-        if any(map(exists, (mask, context_mask))):
-            b, n, _, device = *x.size(), x.device
-            q_mask = default(mask, lambda: torch.ones((b, n), device = device).bool())
-            k_mask = q_mask if not exists(context) else context_mask
-            k_mask = default(k_mask, lambda: torch.ones((b, context.shape[-2]), device = device).bool())
+    def _make_input_mask(self, mask, context_mask, context):
+        # outputs at padded query positions are not used, so only keys are masked
+        return padding_attn_mask(mask if not exists(context) else context_mask)
 
-            q_mask = rearrange(q_mask, 'b i -> b () i ()')
-            k_mask = rearrange(k_mask, 'b j -> b () () j')
-            return q_mask * k_mask
-        else: return None #input_mask is None if both mask and context_mask are None
+# Cell
+def pool_kv_heads(state_dict, n_heads, n_kv_heads):
+    """
+    Converts `state_dict` with multi-head `Attention` layers for the same model built with `n_kv_heads` key/value heads,
+    key and value projections of each group of n_heads // n_kv_heads heads are mean-pooled (usually followed by
+    short fine-tuning). Other parameters are kept
+    """
+    assert n_heads % n_kv_heads == 0, 'n_heads should be divisible by n_kv_heads'
+    pool = lambda t: t.reshape(n_kv_heads, n_heads // n_kv_heads, -1, *t.shape[1:]).mean(1).flatten(0, 1)
+    res = {}
+    for key, t in state_dict.items():
+        if key.endswith(('in_proj.to_qkv.weight', 'in_proj.to_qkv.bias')):
+            d = state_dict[key.replace('.bias', '.weight')].size(1)
+            assert t.size(0) == 3*d, f'{key} is not a multi-head attention projection'
+            q, k, v = t.split(d)
+            t = torch.cat([q, pool(k), pool(v)])
+        res[key] = t
+    return res
 
 # Cell
 class TransformerEncoderBlock(nn.Module):
@@ -344,60 +745,122 @@ class TransformerEncoderBlock(nn.Module):
     """
     def __init__(self, dim, n_heads = 8, causal = False, mask = None,
                  attn_dropout=0.1, attn_bias=True, ff_dropout=0.1, d_ff=None,
-                 prenorm=False):
+                 prenorm=False, attn_backend='einsum', attn_chunk_size=1024, attn_kv_chunk_size=None,
+                 attn_pos_enc=None, attn_window_size=None, attn_n_global=0, n_kv_heads=None):
         super().__init__()
         self.attn_dropout = attn_dropout # mb separate argument attn_post_dropout
+        attn_kwargs = dict(dropout=attn_dropout, bias=attn_bias, backend=attn_backend,
+                           chunk_size=attn_chunk_size, kv_chunk_size=attn_kv_chunk_size, pos_enc=attn_pos_enc,
+                           window_size=attn_window_size, n_global=attn_n_global, n_kv_heads=n_kv_heads)
         if prenorm:
-            self.attn = Residual(PreNorm(dim, Attention(dim, n_heads=n_heads, causal=causal, dropout=attn_dropout, bias=attn_bias)))
+            self.attn = Residual(PreNorm(dim, Attention(dim, n_heads=n_heads, causal=causal, **attn_kwargs)))
             self.ff = Residual(PreNorm(dim, FeedForward(dim, d_ff=d_ff, dropout=ff_dropout)))
         else:
-            self.attn = PostNorm(dim, Residual(Attention(dim, n_heads=n_heads, causal=causal, dropout=attn_dropout, bias=attn_bias)))
+            self.attn = PostNorm(dim, Residual(Attention(dim, n_heads=n_heads, causal=causal, **attn_kwargs)))
             self.ff = PostNorm(dim, Residual(FeedForward(dim, d_ff=d_ff, dropout=ff_dropout)))
 
-    def forward(self, x, mask=None): #? more args
-        out = self.attn(x, mask=mask)
+    def forward(self, x, mask=None, cache=None, attn_mask=None): #? more args
+        out = self.attn(x, mask=mask, cache=None if cache is None else cache.setdefault('attn', {}), attn_mask=attn_mask)
         out = F.dropout(out, p=self.attn_dropout, training=self.training)
         out = self.ff(out)
         return out
 
 # Cell
 class TransformerEncoder(nn.Module):
+    """
+    Stack of `TransformerEncoderBlock`s
+    checkpoint: int - if k > 0 activations of every k-th layer are recomputed in backward pass instead of being stored
+    attn_pos_enc: str from {None, 'rotary', 'alibi'} - relative position encoding applied in self-attention
+    attn_window_size: int or list of them per layer - sliding window size of local self-attention, None for full
+        attention (see `local_attention`), the first `attn_n_global` tokens are global
+    n_kv_heads: int - number of key/value heads shared by groups of query heads, n_heads by default
+    """
     def __init__(self, dim, depth=6, n_heads=8, causal=False, d_ff=None, attn_dropout=0.1, attn_bias=True,
-                ff_dropout=0.1, prenorm=False, final_norm=None):
+                ff_dropout=0.1, prenorm=False, final_norm=None, attn_backend='einsum', attn_chunk_size=1024,
+                attn_kv_chunk_size=None, checkpoint=0, attn_pos_enc=None, attn_window_size=None, attn_n_global=0,
+                n_kv_heads=None):
         super().__init__()
         self.dim = dim
+        self.checkpoint = int(checkpoint)
         self.layers = nn.ModuleList([])
-        for _ in range(depth):
+        for window_size in _per_layer(attn_window_size, depth):
             self.layers.append(TransformerEncoderBlock(dim, n_heads, causal=causal, d_ff=d_ff,
-                                    attn_dropout=attn_dropout, ff_dropout=ff_dropout, prenorm=prenorm, attn_bias=attn_bias))
+                                    attn_dropout=attn_dropout, ff_dropout=ff_dropout, prenorm=prenorm, attn_bias=attn_bias,
+                                    attn_backend=attn_backend, attn_chunk_size=attn_chunk_size,
+                                    attn_kv_chunk_size=attn_kv_chunk_size, attn_pos_enc=attn_pos_enc,
+                                    attn_window_size=window_size, attn_n_global=attn_n_global, n_kv_heads=n_kv_heads))
         self.norm = None if final_norm is None else final_norm(dim)
-    def forward(self, x, mask=None):
-        for layer in self.layers:
-            x = layer(x, mask=mask)
+    def forward(self, x, mask=None, cache=None, attn_mask=None):
+        # attention mask is shared by all layers, with cache it's extended by each layer from cached padding mask
+        if attn_mask is None and cache is None: attn_mask = padding_attn_mask(mask)
+        for i, layer in enumerate(self.layers):
+            if self._checkpoint_layer(i, cache): x = _checkpoint(layer, x, mask, None, attn_mask)
+            else: x = layer(x, mask=mask, cache=None if cache is None else cache.setdefault(i, {}), attn_mask=attn_mask)
         if self.norm is not None:
             x = self.norm(x)
         return x
+    def _checkpoint_layer(self, i, cache):
+        return self.checkpoint > 0 and i % self.checkpoint == 0 and cache is None and torch.is_grad_enabled()
+
+# Cell
+def evict_cache(cache, max_len):
+    "Keeps only last `max_len` positions of self-attention keys and values stored in `cache`"
+    for layer_cache in cache.values():
+        attn_cache = layer_cache.get('attn', {})
+        for key in ('k', 'v', 'mask'):
+            if key in attn_cache:
+                t = attn_cache[key]
+                attn_cache[key] = t[:, t.size(1)-max_len:]
+    return cache
+
+def truncate_cache(cache, length):
+    "Keeps only first `length` positions of self-attention keys and values stored in `cache`, e.g. to drop rejected tokens"
+    for layer_cache in cache.values():
+        attn_cache = layer_cache.get('attn', {})
+        for key in ('k', 'v', 'mask'):
+            if key in attn_cache: attn_cache[key] = attn_cache[key][:, :length]
+    return cache
+
+def reorder_cache(cache, idx, keep_static=False):
+    """
+    Selects batch elements `idx` of all tensors stored in `cache`, e.g. to follow beams or drop finished sequences.
+    If `keep_static` is True cross-attention keys and values computed from context are left untouched
+    """
+    for key, val in cache.items():
+        if keep_static and key in ('cross', 'context_k', 'context_v'): continue
+        if isinstance(val, dict): reorder_cache(val, idx, keep_static)
+        else: cache[key] = val.index_select(0, idx)
+    return cache
 
 # Cell
 class TransformerDecoderBlock(nn.Module):
+    """
+    Decoder block, relative position encoding `attn_pos_enc` and local attention window only apply to self-attention,
+    `n_kv_heads` to both self- and cross-attention
+    """
     def __init__(self, dim, n_heads = 8, mask = None, d_ff=None,
                  attn_dropout=0.1, ff_dropout=0.1, attn_bias=True,
-                 prenorm=False):
+                 prenorm=False, attn_backend='einsum', attn_chunk_size=1024, attn_kv_chunk_size=None,
+                 attn_pos_enc=None, attn_window_size=None, attn_n_global=0, n_kv_heads=None):
         super().__init__()
         self.attn_dropout = attn_dropout # mb separate argument attn_post_dropout
+        attn_kwargs = dict(dropout=attn_dropout, bias=attn_bias, backend=attn_backend,
+                           chunk_size=attn_chunk_size, kv_chunk_size=attn_kv_chunk_size, n_kv_heads=n_kv_heads)
+        self_attn_kwargs = dict(attn_kwargs, pos_enc=attn_pos_enc, window_size=attn_window_size, n_global=attn_n_global)
         if prenorm:
-            self.attn = Residual(PreNorm(dim, Attention(dim, n_heads=n_heads, causal=True, dropout=attn_dropout, bias=attn_bias)))
-            self.cross = Residual(PreNorm(dim, Attention(dim, n_heads=n_heads, causal=False, dropout=attn_dropout, bias=attn_bias)))
+            self.attn = Residual(PreNorm(dim, Attention(dim, n_heads=n_heads, causal=True, **self_attn_kwargs)))
+            self.cross = Residual(PreNorm(dim, Attention(dim, n_heads=n_heads, causal=False, **attn_kwargs)))
             self.ff = Residual(PreNorm(dim, FeedForward(dim, d_ff=d_ff, dropout=ff_dropout)))
         else:
-            self.attn = PostNorm(dim, Residual(Attention(dim, n_heads=n_heads, causal=True, dropout=attn_dropout, bias=attn_bias)))
-            self.cross = PostNorm(dim, Residual(Attention(dim, n_heads=n_heads, causal=False, dropout=attn_dropout, bias=attn_bias)))
+            self.attn = PostNorm(dim, Residual(Attention(dim, n_heads=n_heads, causal=True, **self_attn_kwargs)))
+            self.cross = PostNorm(dim, Residual(Attention(dim, n_heads=n_heads, causal=False, **attn_kwargs)))
             self.ff = PostNorm(dim, Residual(FeedForward(dim, d_ff=d_ff, dropout=ff_dropout)))
 
-    def forward(self, x, context, mask=None, context_mask=None):
-        out = self.attn(x, mask=mask)
+    def forward(self, x, context, mask=None, context_mask=None, cache=None, attn_mask=None, context_attn_mask=None):
+        out = self.attn(x, mask=mask, cache=None if cache is None else cache.setdefault('attn', {}), attn_mask=attn_mask)
         out = F.dropout(out, p=self.attn_dropout, training=self.training)
-        out = self.cross(out, context, mask=mask, context_mask=context_mask)
+        out = self.cross(out, context, mask=mask, context_mask=context_mask,
+                         cache=None if cache is None else cache.setdefault('cross', {}), attn_mask=context_attn_mask)
         out = F.dropout(out, p=self.attn_dropout, training=self.training)
         out = self.ff(out)
         return out
@@ -406,88 +869,175 @@ class TransformerDecoderBlock(nn.Module):
 class TransformerDecoderBlockV2(nn.Module):
     def __init__(self, dim, n_heads = 8, mask = None, d_ff=None,
                  attn_dropout=0.1, ff_dropout=0.1, attn_bias=True,
-                 prenorm=False):
+                 prenorm=False, attn_backend='einsum', attn_chunk_size=1024, attn_kv_chunk_size=None,
+                 attn_pos_enc=None, attn_window_size=None, attn_n_global=0, n_kv_heads=None):
         super().__init__()
+        assert attn_pos_enc is None, 'relative position encodings are not supported with combined attention'
+        assert attn_window_size is None, 'local attention is not supported with combined attention'
+        assert n_kv_heads is None, 'grouped-query attention is not supported with combined attention'
         self.attn_dropout = attn_dropout # mb separate argument attn_post_dropout
+        attn_kwargs = dict(dropout=attn_dropout, bias=attn_bias, backend=attn_backend,
+                           chunk_size=attn_chunk_size, kv_chunk_size=attn_kv_chunk_size)
         if prenorm:
-            self.attn = Residual(PreNorm(dim, DecoderAttention(dim, n_heads=n_heads, causal=True, dropout=attn_dropout, bias=attn_bias)))
+            self.attn = Residual(PreNorm(dim, AdditiveAttention(dim, n_heads=n_heads, causal=True, **attn_kwargs)))
             self.ff = Residual(PreNorm(dim, FeedForward(dim, d_ff=d_ff, dropout=ff_dropout)))
         else:
-            self.attn = PostNorm(dim, Residual(DecoderAttention(dim, n_heads=n_heads, causal=True, dropout=attn_dropout, bias=attn_bias)))
+            self.attn = PostNorm(dim, Residual(AdditiveAttention(dim, n_heads=n_heads, causal=True, **attn_kwargs)))
             self.ff = PostNorm(dim, Residual(FeedForward(dim, d_ff=d_ff, dropout=ff_dropout)))
 
-    def forward(self, x, context, mask=None, context_mask=None):
-        out = self.attn(x, context, mask=mask, context_mask=context_mask)
+    def forward(self, x, context, mask=None, context_mask=None, cache=None, attn_mask=None, context_attn_mask=None):
+        out = self.attn(x, context, mask=mask, context_mask=context_mask,
+                        cache=None if cache is None else cache.setdefault('attn', {}),
+                        attn_mask=attn_mask, context_attn_mask=context_attn_mask)
         out = F.dropout(out, p=self.attn_dropout, training=self.training)
         out = self.ff(out)
         return out
 
 # Cell
 class TransformerDecoder(nn.Module):
+    """
+    Stack of `TransformerDecoderBlock`s (`TransformerDecoderBlockV2` if `comb_attn`)
+    checkpoint: int - if k > 0 activations of every k-th layer are recomputed in backward pass instead of being stored
+    attn_pos_enc: str from {None, 'rotary', 'alibi'} - relative position encoding applied in self-attention
+    attn_window_size: int or list of them per layer - sliding window size of local self-attention, None for full
+        attention (see `local_attention`), the first `attn_n_global` tokens are global
+    n_kv_heads: int - number of key/value heads shared by groups of query heads, n_heads by default
+    """
     def __init__(self, dim, depth=6, n_heads=8, d_ff=None, attn_dropout=0.1, ff_dropout=0.1,
-                 prenorm=False, comb_attn=False, attn_bias=True, final_norm=None):
+                 prenorm=False, comb_attn=False, attn_bias=True, final_norm=None, attn_backend='einsum',
+                 attn_chunk_size=1024, attn_kv_chunk_size=None, checkpoint=0, attn_pos_enc=None,
+                 attn_window_size=None, attn_n_global=0, n_kv_heads=None):
         super().__init__()
         self.dim = dim
+        self.checkpoint = int(checkpoint)
         self.layers = nn.ModuleList([])
         block = TransformerDecoderBlockV2 if comb_attn else TransformerDecoderBlock
-        for _ in range(depth):
-            self.layers.append(block(dim, n_heads, d_ff=d_ff, attn_dropout=attn_dropout, ff_dropout=ff_dropout, prenorm=prenorm, attn_bias=attn_bias))
+        for window_size in _per_layer(attn_window_size, depth):
+            self.layers.append(block(dim, n_heads, d_ff=d_ff, attn_dropout=attn_dropout, ff_dropout=ff_dropout, prenorm=prenorm, attn_bias=attn_bias,
+                                     attn_backend=attn_backend, attn_chunk_size=attn_chunk_size,
+                                     attn_kv_chunk_size=attn_kv_chunk_size, attn_pos_enc=attn_pos_enc,
+                                     attn_window_size=window_size, attn_n_global=attn_n_global, n_kv_heads=n_kv_heads))
         self.norm = None if final_norm is None else final_norm(dim)
-    def forward(self, x, context, mask=None, context_mask=None):
-        for layer in self.layers:
-            x = layer(x, context, mask, context_mask)
+    def forward(self, x, context, mask=None, context_mask=None, cache=None, attn_mask=None, context_attn_mask=None):
+        # attention masks are shared by all layers, with cache self-attention mask is extended by each layer
+        if attn_mask is None and cache is None: attn_mask = padding_attn_mask(mask)
+        context_attn_mask = default(context_attn_mask, padding_attn_mask(context_mask))
+        for i, layer in enumerate(self.layers):
+            if self._checkpoint_layer(i, cache):
+                x = _checkpoint(layer, x, context, mask, context_mask, None, attn_mask, context_attn_mask)
+            else:
+                x = layer(x, context, mask, context_mask, cache=None if cache is None else cache.setdefault(i, {}),
+                          attn_mask=attn_mask, context_attn_mask=context_attn_mask)
         if self.norm is not None:
             x = self.norm(x)
         return x
+    def _checkpoint_layer(self, i, cache):
+        return self.checkpoint > 0 and i % self.checkpoint == 0 and cache is None and torch.is_grad_enabled()
 
 # Cell
+def _positions(table, n, offset=0, pos_ids=None):
+    """
+    Rows of positional encoding `table` [max_seq_len, d] for `n` positions starting at `offset` or at `pos_ids`,
+    int offset is a slice of the table, tensor offset (e.g. in traced decoding step or per row [bs, 1]) is gathered
+    """
+    if exists(pos_ids): return table[pos_ids]
+    if isinstance(offset, int): return table[offset:offset+n]
+    return table[torch.arange(n, device=table.device) + offset]
+
 class AbsolutePositionalEmbedding(nn.Module):
     def __init__(self, dim, max_seq_len):
         super().__init__()
         self.emb = nn.Embedding(max_seq_len, dim)
 
-    def forward(self, x):
-        t = torch.arange(x.shape[1], device=x.device)
-        return self.emb(t)
+    def forward(self, x, offset=0, pos_ids=None):
+        return _positions(self.emb.weight, x.size(1), offset, pos_ids)
 
 class FixedPositionalEmbedding(nn.Module):
-    def __init__(self, dim):
+    "Sinusoidal positional encodings, table of `max_seq_len` positions is precomputed and extended on demand"
+    def __init__(self, dim, max_seq_len=512):
         super().__init__()
         inv_freq = 1. / (10000 ** (torch.arange(0, dim, 2).float() / dim))
         self.register_buffer('inv_freq', inv_freq)
+        self.register_buffer('table', self._table(max_seq_len), persistent=False)
 
-    def forward(self, x):
-        t = torch.arange(x.shape[1], device=x.device).type_as(self.inv_freq)
-        sinusoid_inp = torch.einsum("i,j->ij", t, self.inv_freq)
-        emb = torch.cat((sinusoid_inp.sin(), sinusoid_inp.cos()), dim=-1)
-        return emb[None, :, :]
+    def _table(self, n):
+        sinusoid_inp = torch.arange(n, device=self.inv_freq.device).type_as(self.inv_freq)[:, None] * self.inv_freq
+        return torch.cat((sinusoid_inp.sin(), sinusoid_inp.cos()), dim=-1)
+
+    def forward(self, x, offset=0, pos_ids=None):
+        if isinstance(offset, int) and offset + x.size(1) > self.table.size(0): self.table = self._table(offset + x.size(1))
+        return _positions(self.table, x.size(1), offset, pos_ids)
+
+def segment_positions(segment_ids):
+    "Positions of tokens within packed sequences, restart from 0 wherever segment id changes"
+    idx = torch.arange(segment_ids.size(1), device=segment_ids.device).expand_as(segment_ids)
+    is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+    is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    return idx - torch.where(is_start, idx, torch.zeros_like(idx)).cummax(1)[0]
+
+# axial position helpers (subjected to review)
+def get_axial_dims(dim, n):
+    res = (dim//n, )*(n-1)
+    res += (dim-sum(res), )
+    return res
+
+def _axial_positional_embedding(dim, axial_shape, axial_emb_dims):
+    # optional dependency is only imported when axial positional encoding is used
+    try: from axial_positional_embedding import AxialPositionalEmbedding
+    except ImportError:
+        raise ImportError("pos_enc='axial' requires axial_positional_embedding package: "
+                          "pip install standard_transformer[axial]") from None
+    return AxialPositionalEmbedding(dim, axial_shape, axial_emb_dims)
 
 class TransformerEmbedding(nn.Module):
     """
     Combines token embedings with positional encodings
-    pos_enc: str from {'absolute', 'fixed', 'axial'}
+    pos_enc: str from {'absolute', 'fixed', 'axial', 'rotary', 'alibi'} - rotary and alibi are relative encodings
+        applied in attention layers (see `attn_pos_enc`), nothing is added to token embeddings then
+    offset: int - position of the first token of x, used for cached decoding, can be tensor [bs, 1] of per-row offsets
+    pos_ids: optional positions [bs, sl], e.g. `segment_positions` of packed sequences
+    Positional encodings are sliced from tables of `max_seq_len` positions, axial table is materialized once in eval mode
     """
     def __init__(self, emb_sz, dim, max_seq_len=512, dropout=0., pos_enc='absolute',
                  axial_shape=None, axial_emb_dims=None):
         super().__init__()
         self.scale = dim**0.5
+        self.pos_enc_type, self.max_seq_len = pos_enc, max_seq_len
         self.emb = nn.Embedding(emb_sz, dim)
         if pos_enc == 'absolute':
             self.pos_enc = AbsolutePositionalEmbedding(dim, max_seq_len)
         elif pos_enc == 'fixed':
-            self.pos_enc = FixedPositionalEmbedding(dim)
+            self.pos_enc = FixedPositionalEmbedding(dim, max_seq_len)
         elif pos_enc == 'axial':
             assert axial_shape is not None
             assert reduce(mul, axial_shape) == max_seq_len
             axial_emb_dims = default(axial_emb_dims, get_axial_dims(dim, len(axial_shape)))
-            self.pos_enc = AxialPositionalEmbedding(dim, axial_shape, axial_emb_dims)
+            self.pos_enc = _axial_positional_embedding(dim, axial_shape, axial_emb_dims)
+            self.register_buffer('axial_table', None, persistent=False)
+            self._axial_key = None
+        else:
+            assert pos_enc in ('rotary', 'alibi'), f'unknown pos_enc {pos_enc}'
+            self.pos_enc = None
         self.dropout = nn.Dropout(dropout)
         self._init()
-    def forward(self, x):
+    def forward(self, x, offset=0, pos_ids=None):
         x = self.emb(x)
         x *= self.scale
-        x += self.pos_enc(x)
+        if self.pos_enc_type == 'axial': x += _positions(self._axial_table(x), x.size(1), offset, pos_ids)
+        elif not self.relative: x += self.pos_enc(x, offset, pos_ids)
         return self.dropout(x)
+    @property
+    def relative(self):
+        "Positions are encoded relatively in attention layers, so sequences aren't limited by `max_seq_len`"
+        return self.pos_enc_type in ('rotary', 'alibi')
+    def _axial_table(self, x):
+        "Full axial encodings table [max_seq_len, d], in eval mode it's recomputed only when parameters change"
+        if self.training: return self.pos_enc(x.new_empty(1, self.max_seq_len, x.size(-1)))[0]
+        key = tuple((p.data_ptr(), p._version) for p in self.pos_enc.parameters())
+        if self.axial_table is None or key != self._axial_key:
+            with torch.no_grad(): self.axial_table = self.pos_enc(x.new_empty(1, self.max_seq_len, x.size(-1)))[0]
+            self._axial_key = key
+        return self.axial_table
     def _init(self):
         nn.init.trunc_normal_(self.emb.weight, std=1/self.scale)
         # 0.02 works worse then std=1 for pe, trying d_emb**-0.5
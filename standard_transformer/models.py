@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 02_models.ipynb (unless otherwise specified).
 
-__all__ = ['top_p_filter', 'top_k_filter', 'sampler', 'get_axial_dims', 'LMMixin', 'EncDecMixin', 'TransformerLM',
-           'Transformer']
+__all__ = ['sample_logits', 'sampling_probs', 'beam_search', 'LMMixin', 'EncDecMixin', 'TransformerLM',
+           'speculative_decoding', 'Transformer']
 
 # Cell
 import torch
@@ -16,38 +16,152 @@ from .layers import *
 
 # Cell
 # generative helpers
-# credit https://github.com/huggingface/transformers/blob/a0c62d249303a68f5336e3f9a96ecf9241d7abbe/src/transformers/generation_logits_process.py
-def top_p_filter(logits, top_p=0.9):
-    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-    cum_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-    sorted_indices_to_remove = cum_probs > top_p
-    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-    sorted_indices_to_remove[..., 0] = 0
-    # if min_tokens_to_keep > 1:
-    #         # Keep at least min_tokens_to_keep (set to min_tokens_to_keep-1 because we add the first one below)
-    #         sorted_indices_to_remove[..., : min_tokens_to_keep - 1] = 0
-    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-    logits[indices_to_remove] = float('-inf')
-    return logits
-
-def top_k_filter(logits, top_k=20):
-    indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-    logits[indices_to_remove] = float('-inf')
-    return logits
-
-sampler = {
-    'top_k':top_k_filter,
-    'top_p':top_p_filter,
-    'gready':lambda x: x.argmax(-1)
-}
+def _as_rows(v, bs, dtype, device):
+    return torch.as_tensor(v, dtype=dtype, device=device).expand(bs)
+
+def _process_logits(logits, temperature, top_k, top_p, repetition_penalty, prev):
+    "Returns penalized float32 `logits` scaled by `temperature`, greedy samples and per-row parameters"
+    logits = logits.float()
+    bs, vocab_sz = logits.shape
+    temperature = _as_rows(temperature, bs, torch.float, logits.device)
+    top_k = _as_rows(top_k, bs, torch.long, logits.device)
+    top_p = _as_rows(top_p, bs, torch.float, logits.device)
+    if exists(prev):
+        # credit https://github.com/huggingface/transformers/blob/a0c62d249303a68f5336e3f9a96ecf9241d7abbe/src/transformers/generation_logits_process.py
+        penalty = _as_rows(repetition_penalty, bs, torch.float, logits.device)[:, None]
+        score = logits.gather(1, prev)
+        logits = logits.scatter(1, prev, torch.where(score < 0, score * penalty, score / penalty))
+    greedy = logits.argmax(-1)
+    logits = logits / temperature.clamp(min=1e-5)[:, None]
+    top_k = top_k.masked_fill(top_k <= 0, vocab_sz).clamp(max=vocab_sz)
+    return logits, greedy, temperature, top_k, top_p
+
+def _candidates(logits, top_k, top_p, min_candidates):
+    """
+    Returns ids [bs, k] of the most likely tokens and their probabilities with ones removed by `top_k` and `top_p`
+    zeroed. At least `min_candidates` tokens are selected, more are added until they hold `top_p` mass of all rows
+    """
+    vocab_sz = logits.size(-1)
+    # rows filtered by top-k only need exactly `top_k` candidates
+    k = min(vocab_sz, max(min_candidates, int(top_k.masked_fill(top_p < 1, 1).max())))
+    log_z = logits.logsumexp(-1, keepdim=True)
+    while True:
+        cand_logits, cand_idx = logits.topk(k, -1)
+        probs = (cand_logits - log_z).exp()
+        if k == vocab_sz or ((top_k <= k) | (probs.sum(-1) >= top_p)).all(): break
+        k = min(vocab_sz, 4 * k)
+    remove = torch.arange(k, device=logits.device)[None] >= top_k[:, None]
+    # tokens are kept until cumulative probability of the preceding ones exceeds top_p, so the first one always is
+    remove |= probs.cumsum(-1) - probs > top_p[:, None]
+    return cand_idx, probs.masked_fill(remove, 0.)
+
+def sample_logits(logits, temperature=1., top_k=0, top_p=1., repetition_penalty=1., prev=None, min_candidates=64):
+    """
+    Samples next token ids [bs] from `logits` [bs, vocab_sz] in a single batched pass. Logits of tokens in `prev`
+    [bs, n] are penalized by `repetition_penalty`, then scaled by `temperature` (0 for greedy decoding) and filtered by
+    `top_k` (0 to disable) and `top_p` (1 to disable, probability mass is measured over whole vocabulary).
+    Parameters are scalars or per-row tensors [bs]. Instead of sorting whole vocabulary only the most likely
+    `min_candidates` tokens are selected, candidates are added until they hold `top_p` mass of all rows
+    """
+    logits, greedy, temperature, top_k, top_p = _process_logits(logits, temperature, top_k, top_p,
+                                                                repetition_penalty, prev)
+    if not (temperature > 0).any(): return greedy
+    filtered = (top_k < logits.size(-1)) | (top_p < 1)
+    if not filtered.all():
+        sample = torch.multinomial(F.softmax(logits, -1), 1)[:, 0]
+        if not filtered.any(): return torch.where(temperature > 0, sample, greedy)
+    cand_idx, probs = _candidates(logits, top_k.masked_fill(~filtered, 1), top_p, min_candidates)
+    cand_sample = cand_idx.gather(1, torch.multinomial(probs, 1))[:, 0]
+    sample = torch.where(filtered, cand_sample, sample) if not filtered.all() else cand_sample
+    return torch.where(temperature > 0, sample, greedy)
+
+def sampling_probs(logits, temperature=1., top_k=0, top_p=1., repetition_penalty=1., prev=None, min_candidates=64):
+    "Probabilities [bs, vocab_sz] of tokens sampled by `sample_logits` with the same arguments"
+    logits, greedy, temperature, top_k, top_p = _process_logits(logits, temperature, top_k, top_p,
+                                                                repetition_penalty, prev)
+    vocab_sz = logits.size(-1)
+    probs = F.softmax(logits, -1)
+    filtered = (top_k < vocab_sz) | (top_p < 1)
+    if filtered.any():
+        cand_idx, cand_probs = _candidates(logits, top_k.masked_fill(~filtered, 1), top_p, min_candidates)
+        cand_probs = torch.zeros_like(probs).scatter(1, cand_idx, cand_probs)
+        probs = torch.where(filtered[:, None], cand_probs / cand_probs.sum(-1, keepdim=True), probs)
+    return torch.where((temperature > 0)[:, None], probs, F.one_hot(greedy, vocab_sz).to(probs.dtype))
+
+def _sampling_params(method, bs, device, temperature, top_k, top_p, repetition_penalty):
+    "Per-row `sample_logits` parameters [bs] of `generate` `method`: 'greedy', 'top_k', 'top_p' or 'sample' (both filters)"
+    assert method in ('greedy', 'top_k', 'top_p', 'sample'), f'unknown sampling method {method}'
+    if method == 'greedy': temperature = 0.
+    if method == 'top_p': top_k = 0
+    if method == 'top_k': top_p = 1.
+    return dict(temperature=_as_rows(temperature, bs, torch.float, device), top_k=_as_rows(top_k, bs, torch.long, device),
+                top_p=_as_rows(top_p, bs, torch.float, device),
+                repetition_penalty=_as_rows(repetition_penalty, bs, torch.float, device))
+
+# Cell
+def _append_samples(out, sample, alive, pad_idx):
+    "Appends `sample` of rows `alive` to `out`, finished rows get `pad_idx`"
+    if len(alive) == out.size(0): return torch.cat((out, sample), dim=-1)
+    col = out.new_full((out.size(0), 1), pad_idx)
+    col[alive] = sample
+    return torch.cat((out, col), dim=-1)
+
+def _next_inputs(out, sample, x, offset, cache, max_seq_len, sliding_window=False):
+    "Returns decoder inputs and their position offset for the next generation step"
+    if cache is None: return out[:, -max_seq_len:], 0
+    offset += x.size(1)
+    if offset < max_seq_len: return sample, offset
+    if sliding_window:
+        evict_cache(cache, max_seq_len-1)
+        return sample, max_seq_len-1
+    # recompute self-attention cache for the last max_seq_len tokens
+    evict_cache(cache, 0)
+    return out[:, -max_seq_len:], 0
 
 # Cell
-# axial position helpers (subjected to review)
-def get_axial_dims(dim, n):
-    res = (dim//n, )*(n-1)
-    res += (dim-sum(res), )
-    return res
+def beam_search(step, inp, cache=None, num_beams=4, max_len=50, max_seq_len=512, length_penalty=1.,
+                eos_idx=None, pad_idx=None, sliding_window=False):
+    """
+    Vectorized beam search: beams are folded into batch dimension so all of them are processed by one `step` call.
+    `step(x, offset)` returns next token logits for inputs x of shape [bs*num_beams, sl], `cache` used by `step`
+    (if any) is reordered to follow selected beams.
+    Finished hypotheses are scored by log_prob / length**length_penalty, a sequence is done when none of its
+    alive beams can outscore the worst finished one.
+    Returns sequences [bs, num_beams, sl] padded with `pad_idx` and their scores [bs, num_beams], best first
+    """
+    bs, k, device = inp.size(0), num_beams, inp.device
+    pad_idx = default(pad_idx, default(eos_idx, 0))
+    batch_pos = torch.arange(bs, device=device)[:, None] * k
+    alive_seq = inp.repeat_interleave(k, 0)
+    alive_logp = torch.full((bs, k), float('-inf'), device=device)
+    alive_logp[:, 0] = 0 # all beams start equal, keep only one of them at the first step
+    fin_seq = inp.new_full((bs, k, inp.size(1)), pad_idx)
+    fin_scores = torch.full((bs, k), float('-inf'), device=device)
+    x, offset = alive_seq[:, -max_seq_len:], 0
+    for i in range(max_len):
+        logp = F.log_softmax(step(x, offset).float(), dim=-1)
+        vocab_sz = logp.size(-1)
+        top_logp, top_idx = (alive_logp[..., None] + logp.view(bs, k, -1)).view(bs, -1).topk(2*k, dim=-1)
+        parent = batch_pos + top_idx // vocab_sz
+        tok = top_idx % vocab_sz
+        cand_seq = torch.cat([alive_seq[parent.view(-1)], tok.view(-1, 1)], dim=-1).view(bs, 2*k, -1)
+        is_eos = (tok == eos_idx) if exists(eos_idx) else torch.zeros_like(tok, dtype=torch.bool)
+        # hypotheses ending with eos compete with previously finished ones
+        cand_scores = (top_logp / (i+1)**length_penalty).masked_fill(~is_eos, float('-inf'))
+        fin_seq = torch.cat([F.pad(fin_seq, (0, 1), value=pad_idx), cand_seq], dim=1)
+        fin_scores, fin_idx = torch.cat([fin_scores, cand_scores], dim=1).topk(k, dim=-1)
+        fin_seq = fin_seq.gather(1, fin_idx[..., None].expand(-1, -1, fin_seq.size(-1)))
+        # the rest continue as alive beams
+        alive_logp, alive_idx = top_logp.masked_fill(is_eos, float('-inf')).topk(k, dim=-1)
+        alive_seq = cand_seq.gather(1, alive_idx[..., None].expand(-1, -1, cand_seq.size(-1))).view(bs*k, -1)
+        if exists(cache): reorder_cache(cache, parent.gather(1, alive_idx).view(-1), keep_static=True)
+        done = fin_scores[:, -1] > alive_logp[:, 0] / max_len**length_penalty
+        if done.all(): break
+        x, offset = _next_inputs(alive_seq, alive_seq[:, -1:], x, offset, cache, max_seq_len, sliding_window)
+    # alive beams compete with finished hypotheses and fill slots left without them
+    seqs = torch.cat([fin_seq, alive_seq.view(bs, k, -1)], dim=1)
+    scores, idx = torch.cat([fin_scores, alive_logp / (i+1)**length_penalty], dim=1).topk(k, dim=-1)
+    return seqs.gather(1, idx[..., None].expand(-1, -1, seqs.size(-1))), scores
 
 # Cell
 class LMMixin:
@@ -60,31 +174,86 @@ class LMMixin:
                 top_k = 20,
                 top_p = 0.9,
                 early_stopping=False, #need eos_idx to work
-                eos_idx=None):
+                eos_idx=None,
+                use_cache=True,
+                sliding_window=False,
+                return_lengths=False,
+                repetition_penalty=1.,
+                draft_model=None,
+                n_draft=4):
+        """
+        If `use_cache` is True keys and values of previous positions are cached so each step processes only the new token.
+        Once sequence exceeds `max_seq_len` the cache is recomputed for the last `max_seq_len` tokens,
+        if `sliding_window` is True oldest cached positions are evicted instead. Eviction is faster but approximate:
+        with absolute `pos_enc` cached keys keep encodings of their original positions, with relative `pos_enc`
+        ('rotary' or 'alibi') it's exact for a single layer only, as cached states of deeper layers were computed
+        from the evicted tokens too.
+        With `early_stopping` sequences are finished once they generate `eos_idx`: they are removed from the batch
+        processed by later steps and padded with `pad_idx` (`eos_idx` if model has none). If `return_lengths` is True
+        lengths of sequences (including prompt and eos) are returned as well.
+        Tokens are sampled by `sample_logits`, `temperature`, `top_k`, `top_p` and `repetition_penalty` can be given
+        per row as tensors [bs]. If smaller `draft_model` is given tokens are generated by `speculative_decoding`
+        with `n_draft` tokens proposed per step (use it directly for acceptance rate)
+        """
         self.to(inp.device) #TODO test for potential problems
         self.eval()
-        thresh = top_k if method=='top_k' else top_p
-        sampler = _sampler[method]
         inp = expand_dim1(inp)
         b, t = inp.shape
         out = inp
+        params = _sampling_params(method, b, inp.device, temperature, top_k, top_p, repetition_penalty)
+        if exists(draft_model):
+            out, _ = speculative_decoding(self, draft_model, inp, max_len, n_draft, **params,
+                                          eos_idx=eos_idx if early_stopping else None, pad_idx=self.pad_idx)
+            lengths = _sequence_lengths(out, t, eos_idx if early_stopping else None)
+            return (out, lengths) if return_lengths else out
+        penalize = bool((params['repetition_penalty'] != 1).any())
+        # cached keys and values are only valid if previous positions don't attend to new ones
+        cache = {} if use_cache and self.causal else None
+        # indices of rows which are still generated and their lengths
+        alive, lengths = torch.arange(b, device=inp.device), inp.new_full((b,), t + max_len)
+        x, offset = out[:, -self.max_seq_len:], 0
         for _ in range(max_len):
-            x = out[:, -self.max_seq_len:]
+            # sampling is done in float32 when model runs under autocast
+            logits = self(x, cache=cache, offset=offset)[:, -1, :]
+            sample = sample_logits(logits, prev=out[alive] if penalize else None,
+                                   **{k: v[alive] for k, v in params.items()})[:, None]
 
-            logits = self(x)[:, -1, :]
-            if method == 'greedy':
-                sample = sampler(logits)
-            else:
-                filtered_logits = sampler(logits)
-                probs = F.softmax(filtered_logits / temperature, dim=-1)
-                sample = torch.multinomial(probs, 1)
+            out = _append_samples(out, sample, alive, default(self.pad_idx, eos_idx))
 
-            out = torch.cat((out, sample), dim=-1)
+            if early_stopping and exists(eos_idx):
+                done = sample[:, 0] == eos_idx
+                if done.any():
+                    lengths[alive[done]] = out.size(1)
+                    keep = (~done).nonzero()[:, 0]
+                    alive, sample, x = alive[keep], sample[keep], x[keep]
+                    if not len(alive): break
+                    if exists(cache): reorder_cache(cache, keep)
+            x, offset = _next_inputs(out[alive], sample, x, offset, cache, self.max_seq_len, sliding_window)
+        return (out, lengths) if return_lengths else out
 
-            if early_stopping and (sample == eos_idx).all():
-                break
-        # out = out[:, t:]
-        return out
+    @torch.no_grad()
+    def beam_search(self, inp,
+                    num_beams=4,
+                    max_len=50,
+                    length_penalty=1.,
+                    eos_idx=None,
+                    use_cache=True,
+                    sliding_window=False,
+                    return_all=False):
+        """
+        Beam search decoding (see `beam_search`), returns best sequences [bs, sl]
+        or all beams [bs, num_beams, sl] and their scores if `return_all` is True
+        """
+        self.to(inp.device)
+        self.eval()
+        inp = expand_dim1(inp)
+        cache = {} if use_cache and self.causal else None
+        step = lambda x, offset: self(x, cache=cache, offset=offset)[:, -1, :]
+        seqs, scores = beam_search(step, inp, cache, num_beams=num_beams, max_len=max_len,
+                                   max_seq_len=self.max_seq_len, length_penalty=length_penalty,
+                                   eos_idx=eos_idx, pad_idx=self.pad_idx,
+                                   sliding_window=sliding_window)
+        return (seqs, scores) if return_all else seqs[:, 0]
 
     def store_attention(self, layer_ids=None):
         #defaults to storing attention for all layers
@@ -110,7 +279,7 @@ class LMMixin:
 
 # Cell
 class EncDecMixin:
-    #TODO add beam search and refactor
+    #TODO refactor
     @torch.no_grad()
     def generate(self, src,
                 src_mask=None,
@@ -121,36 +290,80 @@ class EncDecMixin:
                 top_p = 0.9,
                 early_stopping=False,
                 bos_idx=2, # TODO change to match future usecases
-                eos_idx=None):
+                eos_idx=None,
+                use_cache=True,
+                sliding_window=False,
+                return_lengths=False,
+                repetition_penalty=1.):
+        """
+        Source is encoded once. If `use_cache` is True cross-attention keys and values are projected
+        from encoder output once and decoder self-attention keys and values are cached
+        so each step processes only the new token (see `LMMixin.generate` for `sliding_window`).
+        With `early_stopping` sequences are finished once they generate `eos_idx` or `pad_idx`, finished rows and
+        their encoder outputs are removed from the batch (see `LMMixin.generate` for padding, `return_lengths` and sampling)
+        """
         self.to(src.device) #TODO test for potential problems
         self.eval()
-        thresh = top_k if method=='top_k' else top_p
-        sampler = _sampler[method]
         src = expand_dim1(src)
         bs = src.size(0)
         inp = src.new_full((bs, 1), bos_idx) #start with bos tokens
         src_mask = default(src_mask, self.get_padding_mask(src))
-        enc = self.encoder(self.enc_emb(src), mask = src_mask)
+        enc = self.encode(src, src_mask)
         out = inp
+        params = _sampling_params(method, bs, src.device, temperature, top_k, top_p, repetition_penalty)
+        penalize = bool((params['repetition_penalty'] != 1).any())
+        cache = {} if use_cache else None
+        alive, lengths = torch.arange(bs, device=src.device), src.new_full((bs,), 1 + max_len)
+        stop_ids = [i for i in (eos_idx, self.pad_idx) if exists(i)] if early_stopping else []
+        x, offset = out, 0
         for _ in range(max_len):
-            x = out[:, -self.max_seq_len:]
-            dec = self.decoder(self.dec_emb(out), context=enc)
-            logits = self.proj(dec)[:, -1, :]
-            if method == 'greedy':
-                sample = sampler(logits)
-            else:
-                filtered_logits = sampler(logits, thresh)
-                probs = F.softmax(filtered_logits / temperature, dim=-1)
-                sample = torch.multinomial(probs, 1)
-
-            out = torch.cat((out, sample), dim=-1)
-
-            if (early_stopping and
-                ((sample == eos_idx).all() or
-                (sample == self.pad_idx).all())):
-                break
-        #TODO mb output cleanup
-        return out
+            logits = self.decode(x, enc, src_mask, cache=cache, offset=offset)[:, -1, :]
+            sample = sample_logits(logits, prev=out[alive] if penalize else None,
+                                   **{k: v[alive] for k, v in params.items()})[:, None]
+
+            out = _append_samples(out, sample, alive, default(self.pad_idx, eos_idx))
+
+            if stop_ids:
+                done = (sample == sample.new_tensor(stop_ids)).any(1)
+                if done.any():
+                    lengths[alive[done]] = out.size(1)
+                    keep = (~done).nonzero()[:, 0]
+                    alive, sample, x, enc = alive[keep], sample[keep], x[keep], enc[keep]
+                    if not len(alive): break
+                    if exists(src_mask): src_mask = src_mask[keep]
+                    if exists(cache): reorder_cache(cache, keep)
+            x, offset = _next_inputs(out[alive], sample, x, offset, cache, self.max_seq_len, sliding_window)
+        return (out, lengths) if return_lengths else out
+
+    @torch.no_grad()
+    def beam_search(self, src,
+                    src_mask=None,
+                    num_beams=4,
+                    max_len=50,
+                    length_penalty=1.,
+                    bos_idx=2,
+                    eos_idx=None,
+                    use_cache=True,
+                    sliding_window=False,
+                    return_all=False):
+        """
+        Beam search decoding (see `beam_search`), source is encoded once and encoder output is shared by all beams.
+        Returns best sequences [bs, sl] or all beams [bs, num_beams, sl] and their scores if `return_all` is True
+        """
+        self.to(src.device)
+        self.eval()
+        src = expand_dim1(src)
+        src_mask = default(src_mask, self.get_padding_mask(src))
+        enc = self.encode(src, src_mask).repeat_interleave(num_beams, 0)
+        if exists(src_mask): src_mask = src_mask.repeat_interleave(num_beams, 0)
+        inp = src.new_full((src.size(0), 1), bos_idx)
+        cache = {} if use_cache else None
+        step = lambda x, offset: self.decode(x, enc, src_mask, cache=cache, offset=offset)[:, -1, :]
+        seqs, scores = beam_search(step, inp, cache, num_beams=num_beams, max_len=max_len,
+                                   max_seq_len=self.max_seq_len, length_penalty=length_penalty,
+                                   eos_idx=eos_idx, pad_idx=self.pad_idx,
+                                   sliding_window=sliding_window)
+        return (seqs, scores) if return_all else seqs[:, 0]
 
     def store_attention(self, layer_ids=None, store_encoder=False, store_decoder=True):
         #defaults to storing attention for all layers
@@ -203,10 +416,22 @@ class TransformerLM(nn.Module, LMMixin):
         * causal: bool (default: True) - if True does causal masking automatically
         * max_seq_len: int (default: 512)
         * tie_weights: bool - if True target embedding weights are used for computation output projection
-        * pos_enc: str from {'absolute', 'fixed', 'axial'} - type of positional encoding to use
+        * pos_enc: str from {'absolute', 'fixed', 'axial', 'rotary', 'alibi'} - type of positional encoding to use,
+                rotary and alibi encode relative positions in self-attention and have no parameters tied to max_seq_len
+        * attn_backend: str from {'einsum', 'sdpa', 'chunked'} - attention implementation, 'sdpa' uses fused kernels,
+                'chunked' computes attention for blocks of attn_chunk_size queries and attn_kv_chunk_size keys
+        * checkpoint: int (default: 0) - if k > 0 activations of every k-th layer are recomputed in backward pass
+        * attn_window_size: int or list of them per layer - local self-attention window size, None for full attention;
+                the first attn_n_global tokens attend to and are attended by all positions
+        * n_kv_heads: int - number of key/value heads shared by groups of query heads (grouped-query attention),
+                `heads` by default; convert multi-head checkpoints with `pool_kv_heads`
     Inputs:
         * x - input ids, shape [bs, sl]
         * mask - optional boolean mask, shape [bs, sl]
+        * cache - optional dict to store attention keys and values for incremental decoding
+        * offset - position of the first token of x (default: 0), used with cache; tensor [bs, 1] for per-row positions
+        * segment_ids - optional ids of sequences packed into rows of x, shape [bs, sl], 0 at padding;
+                segments attend only to themselves and positions restart for each of them
     Returns:
         * logits - target token logits, shape [bs, sl, vocab_sz]
     """
@@ -214,25 +439,109 @@ class TransformerLM(nn.Module, LMMixin):
                  max_seq_len=512, tie_weights=True, d_ff=None,
                  attn_dropout=0.1, ff_dropout=0.1, emb_dropout=0.1,
                  pos_enc='absolute', pad_idx=None, prenorm=False,
-                 axial_shape=None, axial_emb_dims=None, attn_bias=True):
+                 axial_shape=None, axial_emb_dims=None, attn_bias=True, attn_backend='einsum',
+                 attn_chunk_size=1024, attn_kv_chunk_size=None, checkpoint=0, attn_window_size=None, attn_n_global=0,
+                 n_kv_heads=None):
         super().__init__()
         self.max_seq_len = max_seq_len
         self.n_layers = n_layers
         self.pad_idx = pad_idx
+        self.causal = causal
         self.emb = TransformerEmbedding(vocab_sz, d_model, max_seq_len, dropout=emb_dropout, pos_enc=pos_enc,
                                         axial_shape=axial_shape, axial_emb_dims=axial_emb_dims)
         self.encoder = TransformerEncoder(d_model, n_layers, heads, causal=causal, d_ff=d_ff,
                                        attn_dropout=attn_dropout, ff_dropout=ff_dropout,
-                                       prenorm=prenorm, attn_bias=attn_bias, final_norm=nn.LayerNorm)
+                                       prenorm=prenorm, attn_bias=attn_bias, final_norm=nn.LayerNorm,
+                                       attn_backend=attn_backend, attn_chunk_size=attn_chunk_size,
+                                       attn_kv_chunk_size=attn_kv_chunk_size, checkpoint=checkpoint,
+                                       attn_pos_enc=pos_enc if self.emb.relative else None,
+                                       attn_window_size=attn_window_size, attn_n_global=attn_n_global, n_kv_heads=n_kv_heads)
         self.proj = nn.Linear(d_model, vocab_sz)
         if tie_weights: self.proj.weight = self.emb.emb.weight
 
-    def forward(self, x, mask=None):
-        x = self.emb(x)
-        x = self.encoder(x, mask=mask)
+    def forward(self, x, mask=None, cache=None, offset=0, segment_ids=None):
+        packed = exists(segment_ids)
+        x = self.emb(x, offset=offset, pos_ids=segment_positions(segment_ids) if packed else None)
+        x = self.encoder(x, mask=mask, cache=cache, attn_mask=segment_attn_mask(segment_ids) if packed else None)
         return self.proj(x)
 
 
+# Cell
+def _cache_len(cache):
+    return cache[0]['attn']['k'].size(1) if cache else 0
+
+def _sequence_lengths(out, start, eos_idx):
+    "Lengths of sequences `out` ending at the first `eos_idx` after position `start`"
+    lengths = out.new_full((out.size(0),), out.size(1))
+    if exists(eos_idx):
+        is_eos = out[:, start:] == eos_idx
+        lengths = torch.where(is_eos.any(1), start + is_eos.long().argmax(1) + 1, lengths)
+    return lengths
+
+def _penalized_prefixes(seq, start, n):
+    "Prefixes `seq[:, :start+j]` for j in range(n) [bs, n, start+n-1], padded with the first token of rows"
+    prev = seq[:, None, :start+n-1].repeat(1, n, 1)
+    pad = torch.arange(start+n-1, device=seq.device)[None] >= start + torch.arange(n, device=seq.device)[:, None]
+    return prev.masked_scatter(pad[None].expand_as(prev), seq[:, :1, None].expand_as(prev)[pad[None].expand_as(prev)])
+
+@torch.no_grad()
+def speculative_decoding(model, draft_model, inp, max_len=50, n_draft=4, temperature=1., top_k=0, top_p=1.,
+                         repetition_penalty=1., eos_idx=None, pad_idx=None):
+    """
+    Generates `max_len` tokens after `inp` with causal LM `model`: smaller `draft_model` sharing vocabulary proposes
+    `n_draft` tokens and `model` verifies them in a single forward pass. Draft token is accepted with probability
+    min(1, p/q) of its probabilities by `model` and `draft_model` and the first rejected one is resampled from
+    max(p - q, 0) normalized, so samples follow the distribution of `model` with `sample_logits` parameters.
+    All rows of a batch keep the number of tokens accepted by the row accepting the fewest.
+    Generation stops once all rows have `eos_idx`, positions after it are filled with `pad_idx` (`eos_idx` if None).
+    Returns sequences [bs, t+max_len] and dict with `acceptance_rate` (share of draft tokens accepted by all rows)
+    and `tokens_per_step` (mean number of tokens generated per forward pass of `model`)
+    """
+    assert model.causal and draft_model.causal, 'speculative decoding requires causal models'
+    inp = expand_dim1(inp)
+    b, t = inp.shape
+    assert t + max_len + n_draft <= min(model.max_seq_len, draft_model.max_seq_len), 'sequence would exceed max_seq_len'
+    params = _sampling_params('sample', b, inp.device, temperature, top_k, top_p, repetition_penalty)
+    penalize = bool((params['repetition_penalty'] != 1).any())
+    # target probabilities of all positions of a block are computed in a single call
+    block_params = {k: v.repeat_interleave(n_draft+1) for k, v in params.items()}
+    out, cache, draft_cache = inp, {}, {}
+    n_accepted = n_steps = 0
+    while out.size(1) < t + max_len:
+        l = out.size(1)
+        seq, q = out, []
+        for _ in range(n_draft):
+            n = _cache_len(draft_cache)
+            logits = draft_model(seq[:, n:], cache=draft_cache, offset=n)[:, -1]
+            q.append(sampling_probs(logits, prev=seq if penalize else None, **params))
+            seq = torch.cat([seq, torch.multinomial(q[-1], 1)], 1)
+        draft, q = seq[:, l:], torch.stack(q, 1)
+        n = _cache_len(cache)
+        logits = model(seq[:, n:], cache=cache, offset=n)[:, -n_draft-1:]
+        prev = _penalized_prefixes(seq, l, n_draft+1).flatten(0, 1) if penalize else None
+        p = sampling_probs(logits.flatten(0, 1), prev=prev, **block_params).view(b, n_draft+1, -1)
+        p_draft, q_draft = p[:, :-1].gather(2, draft[..., None])[..., 0], q.gather(2, draft[..., None])[..., 0]
+        accepted = (torch.rand_like(q_draft) * q_draft < p_draft).long().cumprod(1).sum(1)
+        m = int(accepted.min())
+        if m < n_draft:
+            # rows accepting more tokens keep m-th draft token, the rest resample it
+            residual = (p[:, m] - q[:, m]).clamp(min=0)
+            residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, p[:, m])
+            sample = torch.where(accepted > m, draft[:, m], torch.multinomial(residual, 1)[:, 0])
+        else: sample = torch.multinomial(p[:, m], 1)[:, 0]
+        out = torch.cat([out, draft[:, :m], sample[:, None]], 1)
+        # keys and values of rejected tokens are dropped
+        truncate_cache(cache, l + m)
+        truncate_cache(draft_cache, min(l + m, _cache_len(draft_cache)))
+        n_accepted, n_steps = n_accepted + m, n_steps + 1
+        if exists(eos_idx) and (out[:, t:] == eos_idx).any(1).all(): break
+    out = out[:, :t+max_len]
+    if exists(eos_idx):
+        lengths = _sequence_lengths(out, t, eos_idx)
+        pad = torch.arange(out.size(1), device=out.device)[None] >= lengths[:, None]
+        out = out.masked_fill(pad, default(pad_idx, eos_idx))
+    return out, dict(acceptance_rate=n_accepted / (n_steps * n_draft), tokens_per_step=(out.size(1) - t) / n_steps)
+
 # Cell
 ##TODO test weight tying
 # Note on weight tying: it's done like here in fastai AWD_LSTM model
@@ -250,12 +559,25 @@ class Transformer(nn.Module, EncDecMixin):
         * pad_idx: int - padding token id, if pad_idx is provided, and no mask/context_mask are passed to
                 forward method will be used to generate padding masks
         * tie_weights: bool - if True target embedding weights are used for computation output projection
-        * pos_enc: str from {'absolute', 'fixed', 'axial'} - type of positional encoding to use
+        * pos_enc: str from {'absolute', 'fixed', 'axial', 'rotary', 'alibi'} - type of positional encoding to use,
+                rotary and alibi encode relative positions in self-attention and have no parameters tied to max_seq_len
+        * attn_backend: str from {'einsum', 'sdpa', 'chunked'} - attention implementation, 'sdpa' uses fused kernels,
+                'chunked' computes attention for blocks of attn_chunk_size queries and attn_kv_chunk_size keys
+        * checkpoint: int (default: 0) - if k > 0 activations of every k-th encoder and decoder layer are recomputed
+                in backward pass
+        * attn_window_size: int or list of them per layer - local self-attention window size of encoder and decoder,
+                None for full attention; the first attn_n_global tokens attend to and are attended by all positions
+        * n_kv_heads: int - number of key/value heads shared by groups of query heads in all attention layers,
+                `heads` by default; convert multi-head checkpoints with `pool_kv_heads`
     Inputs:
         * src - source input ids, shape [bs, src_sl]
         * tgt - target input ids, shape [bs, tgt_sl]
         * src_mask - optional boolean source mask, shape [bs, src_sl]
         * tgt_mask - optional boolean target mask, shape [bs, tgt_sl]
+        * src_segment_ids, tgt_segment_ids - optional ids of packed sequences, shapes [bs, src_sl] and [bs, tgt_sl],
+                0 at padding; n-th target segment of a row attends to n-th source segment only
+    `encode` and `decode` methods can be used separately, e.g. `decode` with `cache` dict
+    for incremental decoding
     Returns:
         * logits - target token logits, shape [bs, tgt_sl, tgt_vocab_sz]
     """
@@ -266,7 +588,9 @@ class Transformer(nn.Module, EncDecMixin):
                  pos_enc='absolute', d_ff=None, prenorm=False,
                  axial_shape=None, axial_emb_dims=None,
                  comb_attn=False, attn_bias=True, shared_emb=False,
-                 enc_n_layers=None, dec_n_layers=None):
+                 enc_n_layers=None, dec_n_layers=None, attn_backend='einsum',
+                 attn_chunk_size=1024, attn_kv_chunk_size=None, checkpoint=0, attn_window_size=None, attn_n_global=0,
+                 n_kv_heads=None):
         super().__init__()
         self.max_seq_len = max_seq_len
         enc_n_layers = default(enc_n_layers, n_layers)
@@ -283,17 +607,38 @@ class Transformer(nn.Module, EncDecMixin):
             self.dec_emb = TransformerEmbedding(dec_vocab_sz, d_model, max_seq_len, dropout=dec_emb_dropout, pos_enc=pos_enc,
                                                 axial_shape=axial_shape, axial_emb_dims=axial_emb_dims)
         self.encoder = TransformerEncoder(d_model, enc_n_layers, heads, d_ff=d_ff, attn_dropout=attn_dropout, ff_dropout=ff_dropout,
-                                          prenorm=prenorm, attn_bias=attn_bias, final_norm=nn.LayerNorm)
+                                          prenorm=prenorm, attn_bias=attn_bias, final_norm=nn.LayerNorm,
+                                          attn_backend=attn_backend, attn_chunk_size=attn_chunk_size,
+                                          attn_kv_chunk_size=attn_kv_chunk_size, checkpoint=checkpoint,
+                                          attn_pos_enc=pos_enc if self.dec_emb.relative else None,
+                                          attn_window_size=attn_window_size, attn_n_global=attn_n_global, n_kv_heads=n_kv_heads)
         self.decoder = TransformerDecoder(d_model, dec_n_layers, heads, d_ff=d_ff, attn_dropout=attn_dropout, ff_dropout=ff_dropout,
-                                          prenorm=prenorm, comb_attn=comb_attn, attn_bias=attn_bias, final_norm=nn.LayerNorm)
+                                          prenorm=prenorm, comb_attn=comb_attn, attn_bias=attn_bias, final_norm=nn.LayerNorm,
+                                          attn_backend=attn_backend, attn_chunk_size=attn_chunk_size,
+                                          attn_kv_chunk_size=attn_kv_chunk_size, checkpoint=checkpoint,
+                                          attn_pos_enc=pos_enc if self.dec_emb.relative else None,
+                                          attn_window_size=attn_window_size, attn_n_global=attn_n_global, n_kv_heads=n_kv_heads)
         self.proj = nn.Linear(d_model, dec_vocab_sz)
         if tie_weights: self.proj.weight = self.dec_emb.emb.weight
 
-    def forward(self, src, tgt, src_mask = None, tgt_mask = None):
+    def forward(self, src, tgt, src_mask = None, tgt_mask = None, src_segment_ids = None, tgt_segment_ids = None):
         src_mask = default(src_mask, self.get_padding_mask(src))
         tgt_mask = default(tgt_mask, self.get_padding_mask(tgt))
-        enc = self.encoder(self.enc_emb(src), mask = src_mask)
-        out = self.decoder(self.dec_emb(tgt), context=enc, mask=tgt_mask, context_mask=src_mask)
+        enc = self.encode(src, src_mask, segment_ids=src_segment_ids)
+        return self.decode(tgt, enc, src_mask, tgt_mask, segment_ids=tgt_segment_ids, context_segment_ids=src_segment_ids)
+    def encode(self, src, src_mask = None, segment_ids = None):
+        if segment_ids is None: return self.encoder(self.enc_emb(src), mask = src_mask)
+        return self.encoder(self.enc_emb(src, pos_ids=segment_positions(segment_ids)),
+                            attn_mask=segment_attn_mask(segment_ids))
+    def decode(self, tgt, enc, src_mask = None, tgt_mask = None, cache = None, offset = 0,
+               segment_ids = None, context_segment_ids = None):
+        if segment_ids is None:
+            out = self.decoder(self.dec_emb(tgt, offset=offset), context=enc, mask=tgt_mask,
+                               context_mask=src_mask, cache=cache)
+        else:
+            out = self.decoder(self.dec_emb(tgt, pos_ids=segment_positions(segment_ids)), context=enc,
+                               attn_mask=segment_attn_mask(segment_ids),
+                               context_attn_mask=segment_attn_mask(segment_ids, context_segment_ids))
         return self.proj(out)
     def get_padding_mask(self, x):
         if self.pad_idx is None: return None
@@ -0,0 +1,170 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 05_profiling.ipynb (unless otherwise specified).
+
+__all__ = ['LayerProfiler', 'PROFILED_TYPES']
+
+# Cell
+import json, time
+from collections import defaultdict
+from functools import partial
+import torch
+from torch import nn
+
+from .layers import *
+
+# Cell
+PROFILED_TYPES = (TransformerEmbedding, TransformerEncoder, TransformerDecoder, TransformerEncoderBlock,
+                  TransformerDecoderBlock, TransformerDecoderBlockV2, Attention, AdditiveAttention, AttnInProj,
+                  ScaledDotProdAttention, FeedForward, nn.LayerNorm, nn.Linear, nn.Embedding)
+
+def _numel(x):
+    if isinstance(x, torch.Tensor): return x.numel() * x.element_size()
+    if isinstance(x, (tuple, list)): return sum(map(_numel, x))
+    return 0
+
+def _context_cached(m, kwargs):
+    "Whether keys and values of cross-attention context were cached by previous calls of `m`"
+    cache = kwargs.get('cache')
+    return exists(cache) and ('context_k' if isinstance(m, AdditiveAttention) else 'k') in cache
+
+def _own_flops(m, args, kwargs, out, context_cached=False):
+    "Estimated FLOPs of computation done by `m` itself (not by its profiled submodules), matmuls count 2 FLOPs per MAC"
+    if isinstance(m, nn.Linear): return 2 * out.numel() * m.in_features
+    if isinstance(m, nn.LayerNorm): return 5 * out.numel()
+    if isinstance(m, ScaledDotProdAttention):
+        q, k = args[:2]
+        return 4 * q.numel() * k.size(1)
+    if isinstance(m, (AttnInProj, AdditiveAttention)):
+        x = args[0]
+        context = args[1] if len(args) > 1 else kwargs.get('context')
+        # slices of fused `to_qkv` applied to context (and to x for cross-attention) aren't profiled as nn.Linear,
+        # query part has d_model output features and key-value part the rest (fewer for grouped-query attention).
+        # Projections split by `split_qkv` are separate layers
+        flops, n_tokens = 0, lambda t: t.numel() // t.size(-1)
+        if context is not None and not hasattr(m, 'to_kv'):
+            d_in, d_out = m.to_qkv.in_features, m.to_qkv.out_features
+            if not context_cached: flops += 2 * n_tokens(context) * d_in * (d_out - d_in)
+            if isinstance(m, AttnInProj): flops += 2 * n_tokens(x) * d_in * d_in
+        if isinstance(m, AttnInProj): return flops
+        cache = kwargs.get('cache')
+        n_keys = cache['k'].size(1) if exists(cache) else x.size(1)
+        return flops + 4 * x.numel() * (n_keys + (0 if context is None else context.size(1)))
+    return 0
+
+class LayerProfiler:
+    """
+    Context manager recording per-module forward time, FLOP estimates and memory of `model`.
+    Modules of `types` (`PROFILED_TYPES` by default) are instrumented and reported under their `named_modules` names,
+    FLOPs, times and allocations of a module include its submodules. If `trace` is True a `torch.profiler` session
+    is run as well and can be exported with `export_chrome_trace`. On CPU allocations are taken from memory events
+    of `torch.profiler` session which adds some overhead to every op, `memory=False` disables it
+    """
+    def __init__(self, model, types=PROFILED_TYPES, trace=False, memory=True):
+        self.model, self.types, self.trace, self.memory = model, types, trace, memory
+        self.handles, self.records = [], defaultdict(list)
+        self._stack, self._flops, self.profiler = [], 0, None
+        self.cuda = any(p.is_cuda for p in model.parameters())
+
+    def _sync(self):
+        if self.cuda: torch.cuda.synchronize()
+
+    def _pre(self, name, m, args, kwargs=None):
+        self._sync()
+        rf = torch.autograd.profiler.record_function(name)
+        rf.__enter__()
+        alloc = torch.cuda.memory_allocated() if self.cuda else None
+        self._stack.append((rf, time.perf_counter(), self._flops, alloc, _context_cached(m, kwargs or {})))
+
+    def _post(self, name, m, args, kwargs, out=None):
+        if out is None: kwargs, out = {}, kwargs # hook without kwargs
+        self._sync()
+        rf, start, flops, alloc, context_cached = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self._flops += _own_flops(m, args, kwargs or {}, out, context_cached)
+        self.records[name].append(dict(type=type(m).__name__, time=elapsed, flops=self._flops - flops,
+                                       out_bytes=_numel(out),
+                                       alloc_bytes=torch.cuda.memory_allocated() - alloc if self.cuda else None))
+        rf.__exit__(None, None, None)
+
+    def attach(self):
+        "Registers hooks, prefer using `LayerProfiler` as context manager"
+        for name, m in self.model.named_modules():
+            if m is not self.model and not isinstance(m, self.types): continue
+            name = name or type(m).__name__
+            try:
+                self.handles += [m.register_forward_pre_hook(partial(self._pre, name), with_kwargs=True),
+                                 m.register_forward_hook(partial(self._post, name), with_kwargs=True)]
+            except TypeError: # torch<2.0 doesn't pass kwargs to hooks
+                self.handles += [m.register_forward_pre_hook(partial(self._pre, name)),
+                                 m.register_forward_hook(partial(self._post, name))]
+        return self
+
+    def detach(self):
+        "Removes all hooks"
+        for h in self.handles: h.remove()
+        self.handles = []
+
+    @property
+    def _cpu_memory(self): return self.memory and not self.cuda
+
+    def __enter__(self):
+        self.profiler = None
+        if self.trace or self._cpu_memory:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda: activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=self.trace, profile_memory=True)
+            self.profiler.__enter__()
+        return self.attach()
+
+    def __exit__(self, *args):
+        self.detach()
+        if self.profiler is not None:
+            self.profiler.__exit__(*args)
+            if self._cpu_memory: self._cpu_allocs()
+
+    def _cpu_allocs(self):
+        "Sets `alloc_bytes` of calls recorded in profiler session to net memory allocated in their `record_function` ranges"
+        allocs = defaultdict(list)
+        for e in sorted(self.profiler.events(), key=lambda e: e.time_range.start):
+            if e.name in self.records: allocs[e.name].append(e.cpu_memory_usage)
+        for name, a in allocs.items():
+            for rec, alloc in zip(self.records[name][-len(a):], a): rec['alloc_bytes'] = alloc
+
+    def reset(self):
+        "Clears recorded calls"
+        self.records, self._flops = defaultdict(list), 0
+
+    def summary(self, sort_by=None):
+        """
+        Returns list of dicts with aggregated stats per module: number of calls, total and mean time in ms,
+        estimated GFLOPs and achieved GFLOP/s, output and allocated megabytes per call
+        """
+        rows = []
+        for name, recs in self.records.items():
+            total, flops = sum(r['time'] for r in recs), sum(r['flops'] for r in recs)
+            allocs = [r['alloc_bytes'] for r in recs if r['alloc_bytes'] is not None]
+            rows.append(dict(name=name, type=recs[0]['type'], calls=len(recs), total_ms=1e3*total,
+                             mean_ms=1e3*total/len(recs), gflops=flops/1e9, gflops_per_sec=flops/1e9/total if total else 0.,
+                             out_mb=sum(r['out_bytes'] for r in recs)/len(recs)/2**20,
+                             alloc_mb=sum(allocs)/len(allocs)/2**20 if allocs else None))
+        if sort_by is not None: rows.sort(key=lambda r: r[sort_by], reverse=True)
+        return rows
+
+    def print_summary(self, sort_by='total_ms', top=None):
+        "Prints `summary` as a table"
+        rows = self.summary(sort_by)[:top]
+        w = max([len(r['name']) for r in rows] + [4])
+        print(f"{'name':<{w}} {'type':<26} {'calls':>5} {'total ms':>9} {'mean ms':>8} {'GFLOP':>8} {'GFLOP/s':>8} "
+              f"{'out MB':>7} {'alloc MB':>8}")
+        for r in rows:
+            alloc = '-' if r['alloc_mb'] is None else f"{r['alloc_mb']:.2f}"
+            print(f"{r['name']:<{w}} {r['type']:<26} {r['calls']:>5} {r['total_ms']:>9.2f} {r['mean_ms']:>8.3f} "
+                  f"{r['gflops']:>8.3f} {r['gflops_per_sec']:>8.1f} {r['out_mb']:>7.2f} {alloc:>8}")
+
+    def save(self, path):
+        "Saves `summary` to JSON file"
+        with open(path, 'w') as f: json.dump(self.summary(), f, indent=1)
+
+    def export_chrome_trace(self, path):
+        "Exports `torch.profiler` trace (requires `trace=True`) which can be opened in chrome://tracing or Perfetto"
+        assert self.profiler is not None, 'LayerProfiler was created with trace=False'
+        self.profiler.export_chrome_trace(path)
\ No newline at end of file
@@ -0,0 +1,74 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 06_quantization.ipynb (unless otherwise specified).
+
+__all__ = ['TiedQuantizedEmbedding', 'quantize_dynamic', 'compare_quantized']
+
+# Cell
+import copy
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.quantization import quantize_dynamic as _quantize_dynamic, default_dynamic_qconfig, per_channel_dynamic_qconfig
+
+from .layers import *
+
+# Cell
+class TiedQuantizedEmbedding(nn.Module):
+    """
+    Embedding looking up rows of an int8 copy of per-channel quantized weight of dynamically quantized linear layer
+    `proj`, keeps embedding and output projection tied after quantization at the cost of storing the int8 weight twice
+    """
+    def __init__(self, proj):
+        super().__init__()
+        w = proj.weight()
+        assert w.qscheme() == torch.per_channel_affine, 'tied projection should be quantized per output channel'
+        self.register_buffer('weight_int8', w.int_repr())
+        self.register_buffer('scales', w.q_per_channel_scales().float())
+        self.register_buffer('zero_points', w.q_per_channel_zero_points().float())
+    def forward(self, x):
+        return (self.weight_int8[x].float() - self.zero_points[x, None]) * self.scales[x, None]
+
+def _set_module(model, name, module):
+    parent, _, attr = name.rpartition('.')
+    setattr(model.get_submodule(parent) if parent else model, attr, module)
+
+def quantize_dynamic(model, inplace=False):
+    """
+    Returns `model` (copied unless `inplace`) with `nn.Linear` layers replaced by dynamically quantized int8 layers.
+    Linear layers sharing weight with an embedding (`tie_weights=True`) are quantized per output channel and the
+    embeddings are replaced by `TiedQuantizedEmbedding` looking up an int8 copy of the quantized weight. Fused projections of
+    cross-attention are split by `split_qkv` first. Intended for CPU inference
+    """
+    if not inplace: model = copy.deepcopy(model)
+    model.eval()
+    # quantized layers can't be sliced, context is projected by separate key-value layer instead of the whole `to_qkv`
+    for m in list(model.modules()):
+        if isinstance(m, TransformerDecoderBlock):
+            for a in list(m.cross.modules()):
+                if hasattr(a, 'split_qkv'): a.split_qkv()
+        elif isinstance(m, AdditiveAttention): m.split_qkv(keep_fused=True)
+    modules = dict(model.named_modules())
+    embeddings = {}
+    for name, m in modules.items():
+        if isinstance(m, nn.Embedding): embeddings.setdefault(id(m.weight), []).append(name)
+    tied = {name: embeddings[id(m.weight)] for name, m in modules.items()
+            if isinstance(m, nn.Linear) and id(m.weight) in embeddings}
+    qconfig_spec = {nn.Linear: default_dynamic_qconfig, **{name: per_channel_dynamic_qconfig for name in tied}}
+    _quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    for name, emb_names in tied.items():
+        emb = TiedQuantizedEmbedding(model.get_submodule(name))
+        for emb_name in emb_names: _set_module(model, emb_name, emb)
+    return model
+
+# Cell
+@torch.no_grad()
+def compare_quantized(model, qmodel, x, y=None):
+    """
+    Compares LM `model` with its quantized version `qmodel` on input ids `x` and targets `y` (defaults to `x`
+    shifted by one), returns perplexities of both, mean KL divergence and share of matching top-1 predictions
+    """
+    if y is None: x, y = x[:, :-1], x[:, 1:]
+    logits, qlogits = model(x).float(), qmodel(x).float()
+    ppl = lambda l: F.cross_entropy(l.flatten(0, 1), y.flatten()).exp().item()
+    kl = F.kl_div(qlogits.log_softmax(-1), logits.log_softmax(-1), log_target=True, reduction='batchmean')
+    return dict(ppl=ppl(logits), ppl_quantized=ppl(qlogits), kl_div=kl.item() / x.size(1),
+                top1_agreement=(logits.argmax(-1) == qlogits.argmax(-1)).float().mean().item())
\ No newline at end of file
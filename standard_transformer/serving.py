@@ -0,0 +1,158 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 08_serving.ipynb (unless otherwise specified).
+
+__all__ = ['GenerationRequest', 'ContinuousBatcher']
+
+# Cell
+import asyncio
+import torch
+import torch.nn.functional as F
+
+from .layers import *
+from .models import sample_logits
+
+# Cell
+class GenerationRequest:
+    "Prompt, sampling parameters and generated tokens of a request served by `ContinuousBatcher`"
+    def __init__(self, prompt, max_new_tokens=50, temperature=1., top_k=0, top_p=1., eos_idx=None, repetition_penalty=1.):
+        self.prompt, self.max_new_tokens, self.eos_idx = prompt, max_new_tokens, eos_idx
+        self.temperature, self.top_k, self.top_p, self.repetition_penalty = temperature, top_k, top_p, repetition_penalty
+        self.tokens, self.future = [], None
+
+    @property
+    def done(self):
+        return len(self.tokens) >= self.max_new_tokens or (exists(self.eos_idx) and self.tokens[-1:] == [self.eos_idx])
+
+    @property
+    def output(self):
+        "Prompt followed by generated tokens"
+        return torch.cat([self.prompt.cpu(), torch.tensor(self.tokens, dtype=self.prompt.dtype)])
+
+def _merge_caches(a, b):
+    "Concatenates caches along batch dimension, left padding keys, values and masks to common length"
+    if not a: return b
+    res = {}
+    for key, t in a.items():
+        if isinstance(t, dict): res[key] = _merge_caches(t, b[key])
+        else:
+            u, n = b[key], t.size(1) - b[key].size(1)
+            pad = lambda x, n: torch.cat([x.new_zeros(x.size(0), n, *x.shape[2:]), x], 1) if n > 0 else x
+            res[key] = torch.cat([pad(t, -n), pad(u, n)], 0)
+    return res
+
+def _trim_cache(cache, n):
+    "Drops first `n` positions of all cached tensors"
+    for key, t in cache.items():
+        if isinstance(t, dict): _trim_cache(t, n)
+        else: cache[key] = t[:, n:]
+    return cache
+
+# Cell
+class ContinuousBatcher:
+    """
+    Continuous batching scheduler for causal `TransformerLM` `model`: a running batch of up to `max_batch_size`
+    sequences is decoded one token per `step`, requests added with `add` are admitted into free slots and finished ones
+    are retired at every step. `generate` is an asyncio API for use with `serve` running in the same event loop
+    """
+    def __init__(self, model, max_batch_size=32):
+        assert model.causal, 'continuous batching requires causal model'
+        self.model, self.max_batch_size = model.eval(), max_batch_size
+        self.device = next(model.parameters()).device
+        self.pending, self.active, self.cache = [], [], {}
+        self._wakeup = None
+
+    def add(self, prompt, max_new_tokens=50, temperature=1., top_k=0, top_p=1., eos_idx=None, repetition_penalty=1.):
+        """
+        Queues generation of up to `max_new_tokens` tokens after 1d `prompt` (stops after `eos_idx`), sampling
+        parameters are those of `sample_logits`. Returns `GenerationRequest` holding generated `tokens`
+        """
+        assert len(prompt) + max_new_tokens <= self.model.max_seq_len, 'sequence would exceed max_seq_len'
+        req = GenerationRequest(prompt, max_new_tokens, temperature, top_k, top_p, eos_idx, repetition_penalty)
+        self.pending.append(req)
+        if exists(self._wakeup): self._wakeup.set()
+        return req
+
+    def _sample(self, logits, reqs):
+        params = {p: torch.tensor([getattr(r, p) for r in reqs], device=self.device)
+                  for p in ('temperature', 'top_k', 'top_p', 'repetition_penalty')}
+        prev = None
+        if (params['repetition_penalty'] != 1).any():
+            # sequences are left padded with their first token which doesn't change the set of penalized tokens
+            seqs = [r.output for r in reqs]
+            n = max(len(s) for s in seqs)
+            prev = torch.stack([F.pad(s, (n - len(s), 0), value=int(s[0])) for s in seqs]).to(self.device)
+        return sample_logits(logits, prev=prev, **params).tolist()
+
+    def _retire(self, finished):
+        for r in finished:
+            if exists(r.future) and not r.future.done(): r.future.set_result(r.output)
+        return finished
+
+    @torch.no_grad()
+    def _admit(self):
+        "Prefills pending requests while there are free slots, returns the ones finished by their first token"
+        finished = []
+        while self.pending and len(self.active) < self.max_batch_size:
+            # request stays queued until prefilled, so it's failed with the others if prefill raises
+            req = self.pending[0]
+            x = req.prompt.to(self.device)[None]
+            cache = {}
+            logits = self.model(x, mask=torch.ones_like(x, dtype=torch.bool), cache=cache)[:, -1]
+            req.tokens += self._sample(logits, [req])
+            self.pending.pop(0)
+            if req.done: finished.append(req)
+            else:
+                self.active.append(req)
+                self.cache = _merge_caches(self.cache, cache)
+        return finished
+
+    @torch.no_grad()
+    def step(self):
+        "Admits pending requests, runs one decoding step of the running batch and returns requests finished in it"
+        finished = self._admit()
+        if not self.active: return self._retire(finished)
+        x = torch.tensor([[r.tokens[-1]] for r in self.active], device=self.device)
+        offset = torch.tensor([[len(r.prompt) + len(r.tokens) - 1] for r in self.active], device=self.device)
+        logits = self.model(x, mask=torch.ones_like(x, dtype=torch.bool), cache=self.cache, offset=offset)[:, -1]
+        for r, t in zip(self.active, self._sample(logits, self.active)): r.tokens.append(t)
+        keep = [i for i, r in enumerate(self.active) if not r.done]
+        finished += [r for r in self.active if r.done]
+        if len(keep) < len(self.active):
+            self.active = [self.active[i] for i in keep]
+            if not keep: self.cache = {}
+            else:
+                reorder_cache(self.cache, torch.tensor(keep, device=self.device))
+                # positions padded in all remaining rows are dropped
+                mask = self.cache[0]['attn']['mask']
+                _trim_cache(self.cache, int((mask.cumsum(1) == 0).sum(1).min()))
+        return self._retire(finished)
+
+    def run(self):
+        "Steps until all added requests are done"
+        while self.pending or self.active: self.step()
+
+    async def generate(self, prompt, **kwargs):
+        "Adds request (see `add` for `kwargs`) and waits until it's done, returns prompt followed by generated tokens"
+        req = self.add(prompt, **kwargs)
+        req.future = asyncio.get_running_loop().create_future()
+        return await req.future
+
+    def _fail(self, e):
+        "Drops running batch and queued requests, their clients get exception `e`"
+        for r in self.active + self.pending:
+            if exists(r.future) and not r.future.done(): r.future.set_exception(e)
+        self.active, self.pending, self.cache = [], [], {}
+
+    async def serve(self):
+        """
+        Runs decoding steps while there are requests and waits for new ones otherwise, cancel the task to stop.
+        If a step raises, the exception is passed to clients of running and queued requests and serving goes on
+        """
+        self._wakeup = asyncio.Event()
+        while True:
+            if not (self.pending or self.active):
+                await self._wakeup.wait()
+                self._wakeup.clear()
+            try: self.step()
+            except Exception as e: self._fail(e)
+            # lets clients submit requests between steps
+            await asyncio.sleep(0)
\ No newline at end of file